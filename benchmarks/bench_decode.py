@@ -0,0 +1,65 @@
+# Response decoding paths on large district payloads: the old str + stdlib json path against decoding the
+# raw bytes with each available backend, with and without selective extraction, alone and followed by parsing
+#   python benchmarks/bench_decode.py
+#   python benchmarks/bench_decode.py --payload recorded.json
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import json_decoder
+from parse_data import AreaSnapshot
+from payloads import make_district_payload
+from bench_parse import measure
+
+
+SIZES = {
+    'district' : 100,
+    'metro' : 600,
+    'metro_xl' : 1500,
+}
+
+
+def build_cases(body):
+    text_body = body.decode()
+    cases = [ ('text + json (old)', lambda: json.loads(body.decode())) ]
+    for backend in json_decoder.BACKENDS:
+        cases.append(('bytes + {}'.format(backend), lambda backend=backend: json_decoder.decode_calendar(body, False, backend)))
+        cases.append(('bytes + {} selective'.format(backend), lambda backend=backend: json_decoder.decode_calendar(body, True, backend)))
+    cases.append(('old + parse', lambda: AreaSnapshot.build_from_json(json.loads(text_body)['centers'])))
+    for backend in json_decoder.BACKENDS:
+        cases.append(('{} + parse'.format(backend),
+                        lambda backend=backend: AreaSnapshot.build_from_json(json_decoder.decode_calendar(body, False, backend)['centers'])))
+        cases.append(('{} selective + parse'.format(backend),
+                        lambda backend=backend: AreaSnapshot.build_from_json(json_decoder.decode_calendar(body, True, backend)['centers'])))
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--payload', help='recorded API response to run on instead of the synthetic ones')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.payload:
+        with open(args.payload, 'rb') as fp:
+            bodies = { os.path.basename(args.payload) : fp.read() }
+    else:
+        bodies = { name : json.dumps(make_district_payload(num_centers)).encode() for name, num_centers in SIZES.items() }
+
+    print("backends - {}".format(', '.join(json_decoder.BACKENDS)))
+    for name, body in bodies.items():
+        print("\n{} - {:.0f} KiB".format(name, len(body) / 1024))
+        baseline = None
+        for case_name, func in build_cases(body):
+            res = measure(func, args.repeat)
+            baseline = baseline or res['time_us']
+            print("  {:28} {:10.1f} us  x{:5.2f}  peak {:9.1f} KiB".format(case_name, res['time_us'], baseline / res['time_us'], res['peak_kib']))
+        full, slim = json_decoder.decode_calendar(body, False, 'json'), json_decoder.decode_calendar(body, True, 'json')
+        print("  retained json size: full {:.0f} KiB, selective {:.0f} KiB".format(len(json.dumps(full)) / 1024, len(json.dumps(slim)) / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# Microbenchmarks for parsing, filtering, slot counting, top-N selection, rendering and chunking
+#   python benchmarks/bench_parse.py                               synthetic payloads of every size
+#   python benchmarks/bench_parse.py --payload recorded.json       a recorded calendarByDistrict/Pin response
+#   python benchmarks/bench_parse.py --save-baseline base.json     store the results ..
+#   python benchmarks/bench_parse.py --compare base.json           .. and compare a later run against them
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from telegram import constants
+
+from parse_data import AreaSnapshot, CowinCenterSession
+from bot_data_handler import BotDataHandler
+from render import FRAGMENTS
+from payloads import make_district_payload
+
+
+SIZES = {
+    'pincode' : 5,
+    'district' : 100,
+    'metro' : 600,
+}
+AGE_GROUPS = [18, 45, CowinCenterSession.ALL_AGE]
+TOP_N = 5
+
+
+def build_cases(centers_json):
+    def parse():
+        return AreaSnapshot.build_from_json(centers_json)
+
+    def multi_age_filter():
+        snapshot = AreaSnapshot.build_from_json(centers_json)
+        return [ snapshot.get_filtered_centers(age, 1) for age in AGE_GROUPS ]
+
+    snapshot = AreaSnapshot.build_from_json(centers_json)
+    filtered = { age : snapshot.get_filtered_centers(age, 1) for age in AGE_GROUPS }
+    all_age_centers = filtered[CowinCenterSession.ALL_AGE]
+
+    def slot_count():
+        return [ sum(ct.available_capacity_ for ct in filtered[age]) for age in AGE_GROUPS ]
+
+    def top_n():
+        return [ sorted(filtered[age], key = lambda ct: -ct.available_capacity_)[:TOP_N] for age in AGE_GROUPS ]
+
+    def render_cold():
+        # every centre rendered from scratch, as on a poll where all of them changed
+        with FRAGMENTS.lock:
+            FRAGMENTS.fragments.clear()
+        return [ str(ct) for ct in all_age_centers ]
+
+    def render_warm():
+        # every fragment already cached, as on a poll where nothing changed
+        return [ str(ct) for ct in all_age_centers ]
+
+    def chunk():
+        return BotDataHandler.get_chunked_msg_text(all_age_centers, constants.MAX_MESSAGE_LENGTH)
+
+    return [ ('parse', parse), ('multi_age_filter', multi_age_filter), ('slot_count', slot_count),
+             ('top_n', top_n), ('render_cold', render_cold), ('render_warm', render_warm), ('chunk', chunk) ]
+
+
+def measure(func, repeat):
+    number = 1
+    while timeit.timeit(func, number=number) < 0.05 and number < 10000:
+        number *= 4
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return { 'time_us' : best * 1e6, 'peak_kib' : peak / 1024 }
+
+
+def load_payloads(args):
+    if args.payload:
+        with open(args.payload) as fp:
+            data = json.load(fp)
+        return { os.path.basename(args.payload) : data.get('centers', []) }
+    return { name : make_district_payload(num_centers)['centers'] for name, num_centers in SIZES.items() }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--payload', help='recorded API response to run on instead of the synthetic ones')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save-baseline')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+
+    results = {}
+    for payload_name, centers_json in load_payloads(args).items():
+        num_sessions = sum(len(cc['sessions']) for cc in centers_json)
+        print("\n{} - {} centres, {} sessions".format(payload_name, len(centers_json), num_sessions))
+        for case_name, func in build_cases(centers_json):
+            key = '{}/{}'.format(payload_name, case_name)
+            res = results[key] = measure(func, args.repeat)
+            line = "  {:18} {:12.1f} us  peak {:9.1f} KiB".format(case_name, res['time_us'], res['peak_kib'])
+            if key in baseline:
+                line += "   x{:.2f} time, x{:.2f} peak vs baseline".format(res['time_us'] / baseline[key]['time_us'],
+                                                                        res['peak_kib'] / max(baseline[key]['peak_kib'], 1e-9))
+            print(line)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fp:
+            json.dump(results, fp, indent=1)
+        print("\nbaseline saved to {}".format(args.save_baseline))
+
+
+if __name__ == '__main__':
+    main()
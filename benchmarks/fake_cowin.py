@@ -0,0 +1,125 @@
+# Local stand-in for the CoWIN calendar API. Serves recorded fixtures (see cowin_fixtures.py) and
+# synthetic payloads for areas that have none, with configurable latency and error rate.
+#   python benchmarks/fake_cowin.py --port 8081 --latency 0.2 --error-rate 0.02
+#   COWIN_API_ROOT=http://127.0.0.1:8081 python broadcast.py
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cowin_fixtures import FixtureStore, FIXTURE_SETTINGS
+from payloads import make_district_payload
+
+
+class FakeCowinServer:
+    def __init__(self, fixture_dir = FIXTURE_SETTINGS['dir'], latency = 0.0, error_rate = 0.0, centers_per_district = 100, port = 0):
+        self.fixtures = FixtureStore(fixture_dir)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.centers_per_district = centers_per_district
+        self.synthetic = {}         # (area_code, is_pin) -> gzipped body
+        self.calls = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.port)
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='fake-cowin', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def _synthetic_body(self, area_code, is_pin):
+        key = (area_code, is_pin)
+        with self.lock:
+            body = self.synthetic.get(key)
+        if body is None:
+            seed = int(area_code) if area_code.isdigit() else hash(area_code)
+            if is_pin:
+                data = make_district_payload(random.Random(seed).randint(1, 8), num_pincodes=1, seed=seed)
+                for center in data['centers']:
+                    center['pincode'] = int(area_code) if area_code.isdigit() else area_code
+            else:
+                data = make_district_payload(self.centers_per_district, seed=seed)
+            body = gzip.compress(json.dumps(data).encode())
+            with self.lock:
+                self.synthetic[key] = body
+        return body
+
+    def get_body(self, path, query):
+        if path.endswith('/calendarByDistrict'):
+            area_code, is_pin = query.get('district_id', [''])[0], False
+        elif path.endswith('/calendarByPin'):
+            area_code, is_pin = query.get('pincode', [''])[0], True
+        else:
+            return None
+        return self.fixtures.load_compressed(area_code, is_pin) or self._synthetic_body(area_code, is_pin)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'   # keep-alive, like the real cdn
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                with server.lock:
+                    server.calls += 1
+                if server.latency:
+                    time.sleep(random.expovariate(1.0 / server.latency))
+                body = server.get_body(url.path, parse_qs(url.query))
+                if body is None:
+                    self._reply(404, b'{}')
+                elif random.random() < server.error_rate:
+                    with server.lock:
+                        server.errors += 1
+                    self._reply(500, b'{"errorCode":"APPOIN0000","error":"Internal Server Error"}')
+                else:
+                    self._reply(200, body, gzipped=True)
+
+            def _reply(self, status, body, gzipped = False):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                if gzipped:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--fixture-dir', default=FIXTURE_SETTINGS['dir'])
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response delay in secs')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--centers', type=int, default=100, help='centres in a synthetic district payload')
+    args = parser.parse_args()
+
+    server = FakeCowinServer(args.fixture_dir, args.latency, args.error_rate, args.centers, args.port)
+    print("fake CoWIN API on {}".format(server.url))
+    server.httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Local stand-in for the Telegram Bot API, counts and times every call instead of delivering it.
+#   python benchmarks/fake_telegram.py --port 8082 --latency 0.05 --error-rate 0.01
+#   TELEGRAM_API_URL=http://127.0.0.1:8082/bot python broadcast.py
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeTelegramServer:
+    # error_rate share of sendMessage calls fail the way a blocked user does (403)
+    def __init__(self, latency = 0.0, error_rate = 0.0, port = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()          # api method -> calls
+        self.msgs_sent = 0
+        self.errors = 0
+        self.first_send = None
+        self.last_send = None
+        self.message_ids = iter(range(1, 1 << 62))
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/bot'.format(self.port)
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='fake-telegram', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def msgs_per_sec(self):
+        with self.lock:
+            if not self.msgs_sent or self.last_send == self.first_send:
+                return 0.0
+            return self.msgs_sent / (self.last_send - self.first_send)
+
+    def handle(self, method, params):
+        if self.latency:
+            time.sleep(random.expovariate(1.0 / self.latency))
+        now = time.monotonic()
+        with self.lock:
+            self.calls[method] += 1
+            if method != 'sendMessage':
+                return 200, {'ok' : True, 'result' : True}
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return 403, {'ok' : False, 'error_code' : 403, 'description' : 'Forbidden: bot was blocked by the user'}
+            self.msgs_sent += 1
+            self.first_send = self.first_send or now
+            self.last_send = now
+            message_id = next(self.message_ids)
+        chat_id = params.get('chat_id')
+        return 200, {'ok' : True, 'result' : {
+            'message_id' : message_id,
+            'date' : int(time.time()),
+            'chat' : {'id' : int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, 'type' : 'private'},
+            'text' : params.get('text', ''),
+        }}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                # /bot<token>/<method>, the library posts json bodies
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    params = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    params = {}
+                status, reply = server.handle(method, params)
+                body = json.dumps(reply).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response delay in secs')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(args.latency, args.error_rate, args.port).start()
+    print("fake Telegram Bot API on {}".format(server.url))
+    try:
+        while True:
+            time.sleep(10)
+            print("calls {}, msgs sent {}, errors {}, {:.1f} msgs/s".format(dict(server.calls), server.msgs_sent, server.errors, server.msgs_per_sec()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# Builds a SQLite db of synthetic subscribers for load tests
+#   python benchmarks/gen_users.py --db sim_users.sqlite --users 100000
+# then point DB_INFO_FILE at a json with {"DB_SETTINGS": {"url": "sqlite:///sim_users.sqlite"}}
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import create_engine, insert
+
+from db_models import Base, User, Subscription
+from parse_data import CowinCenterSession
+
+
+AGE_GROUPS = [18, 45, CowinCenterSession.ALL_AGE]
+
+
+def get_district_ids(states_file, num_districts, rnd):
+    district_ids = []
+    if os.path.exists(states_file):
+        with open(states_file) as fp:
+            district_ids = sorted(int(key) for key in json.load(fp)['district_id_to_name'].keys())
+    if len(district_ids) < num_districts:
+        district_ids += range(10000, 10000 + num_districts - len(district_ids))
+    return rnd.sample(district_ids, num_districts)
+
+
+def generate_users(db_file, num_users, num_districts = 50, num_pincodes = 500, pincode_share = 0.4, extra_share = 0.2,
+                    states_file = 'fetched_data/states.json', seed = 0, chunk_size = 10000):
+    # a few popular areas get most of the users, like the real subscriber base. extra_share of the
+    # users also follow a second area through the subscriptions table
+    rnd = random.Random(seed)
+    engine = create_engine('sqlite:///' + db_file)
+    Base.metadata.create_all(engine)
+
+    district_ids = [ str(district_id) for district_id in get_district_ids(states_file, num_districts, rnd) ]
+    pincodes = [ str(560001 + ind) for ind in range(num_pincodes) ]
+    district_weights = [ 1.0 / (rank + 1) for rank in range(len(district_ids)) ]
+    pincode_weights = [ 1.0 / (rank + 1) for rank in range(len(pincodes)) ]
+
+    def pick_area():
+        if rnd.random() < pincode_share:
+            return 'pincode', rnd.choices(pincodes, pincode_weights)[0]
+        return 'district', rnd.choices(district_ids, district_weights)[0]
+
+    with engine.begin() as conn:
+        for start in range(0, num_users, chunk_size):
+            rows, extra_rows = [], []
+            for ind in range(start, min(num_users, start + chunk_size)):
+                area_type, area_code = pick_area()
+                if rnd.random() < extra_share:
+                    extra_type, extra_code = pick_area()
+                    if (extra_type, extra_code) != (area_type, area_code):
+                        extra_rows.append({'user_id' : 1000000 + ind, 'area_type' : extra_type, 'area_code' : extra_code,
+                                            'age_group' : rnd.choice(AGE_GROUPS), 'is_active' : True})
+                rows.append({
+                    'user_id' : 1000000 + ind,
+                    'uname' : 'sim_user_%d' % ind,
+                    'fname' : 'Sim',
+                    'is_subscribed' : True,
+                    'area_type' : area_type,
+                    'area_code' : area_code,
+                    'age_group' : rnd.choice(AGE_GROUPS),
+                })
+            conn.execute(insert(User), rows)
+            if extra_rows:
+                conn.execute(insert(Subscription), extra_rows)
+    return engine
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='sim_users.sqlite')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--districts', type=int, default=50)
+    parser.add_argument('--pincodes', type=int, default=500)
+    parser.add_argument('--pincode-share', type=float, default=0.4)
+    parser.add_argument('--extra-share', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        sys.exit("{} already exists".format(args.db))
+    generate_users(args.db, args.users, args.districts, args.pincodes, args.pincode_share, args.extra_share, seed=args.seed)
+    print("{} users written to {}".format(args.users, args.db))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# End to end broadcaster sweep against local CoWIN and Telegram stand-ins and a SQLite user base
+#   python benchmarks/load_sim.py --users 100000 --cowin-latency 0.2 --send-rate 1000
+# and, with --handler-requests, a burst of /get_latest commands through the bot's handler lanes
+#   python benchmarks/load_sim.py --users 100000 --sweeps 0 --handler-requests 5000
+# Everything the run writes (user db, response cache, pincode index) stays inside --workdir.
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, ROOT_DIR)
+
+from cowin_fixtures import FIXTURE_SETTINGS
+from fake_cowin import FakeCowinServer
+from fake_telegram import FakeTelegramServer
+from gen_users import generate_users
+
+
+def prepare_workdir(workdir):
+    os.makedirs(os.path.join(workdir, 'fetched_data'), exist_ok=True)
+    states_file = os.path.join(ROOT_DIR, 'fetched_data', 'states.json')
+    if os.path.exists(states_file):
+        shutil.copy(states_file, os.path.join(workdir, 'fetched_data', 'states.json'))
+    os.chdir(workdir)
+
+
+def run_handler_load(num_requests, num_users, cache_ttl):
+    # feeds /get_latest updates to CowinBot the way its dispatcher would, replies go to the telegram stand-in
+    from telegram import Update
+    from bot import CowinBot
+    from bot_data_handler import BotDataHandler
+    from metrics import METRICS
+    from response_store import SqliteResponseStore
+
+    METRICS.enable()
+    cowin_bot = CowinBot('123456:simulated', BotDataHandler(response_cache_time=cache_ttl, shared_cache_file=SqliteResponseStore.DEFAULT_FILE))
+    bot = cowin_bot.updater.bot
+    start = time.perf_counter()
+    for ind in range(num_requests):
+        user_id = 1000000 + random.randrange(num_users)     # see gen_users
+        update = Update.de_json({'update_id' : ind + 1, 'message' : {
+            'message_id' : ind + 1, 'date' : int(time.time()), 'text' : '/get_latest',
+            'chat' : {'id' : user_id, 'type' : 'private'}, 'from' : {'id' : user_id, 'is_bot' : False, 'first_name' : 'sim'}}}, bot)
+        cowin_bot._handler_current_status(update, None)
+    cowin_bot.lanes.shutdown()
+    elapsed = time.perf_counter() - start
+
+    count, avg_wait, max_wait = cowin_bot.lanes.get_wait_stats().get('_handler_current_status', (0, 0.0, 0.0))
+    run_times = [ hist for (name, labels), hist in METRICS.histograms.items() if name == 'bot_command_seconds' and ('command', '_handler_current_status') in labels ]
+    avg_run = sum(hist.total for hist in run_times) / max(1, sum(hist.count for hist in run_times))
+    return num_requests, elapsed, avg_wait, max_wait, avg_run
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workdir', default='sim_run')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--districts', type=int, default=50)
+    parser.add_argument('--pincodes', type=int, default=500)
+    parser.add_argument('--centers', type=int, default=100, help='centres in a synthetic district payload')
+    parser.add_argument('--fixture-dir', default=os.path.join(ROOT_DIR, FIXTURE_SETTINGS['dir']), help='recorded responses to replay')
+    parser.add_argument('--cowin-latency', type=float, default=0.1)
+    parser.add_argument('--cowin-error-rate', type=float, default=0.0)
+    parser.add_argument('--tg-latency', type=float, default=0.03)
+    parser.add_argument('--tg-error-rate', type=float, default=0.0)
+    parser.add_argument('--fetch-rps', type=float, default=0, help='cap on api requests per sec, 0 for none')
+    parser.add_argument('--send-rate', type=float, default=1000, help='global telegram send rate')
+    parser.add_argument('--time-budget', type=float, default=0, help='secs per sweep before remaining areas are deferred, 0 for none')
+    parser.add_argument('--sweeps', type=int, default=1)
+    parser.add_argument('--sweep-interval', type=float, default=10, help='secs from the start of one sweep to the next')
+    parser.add_argument('--cache-ttl', type=float, default=5, help='response cache secs, below --sweep-interval so every sweep fetches')
+    parser.add_argument('--handler-requests', type=int, default=0, help='/get_latest commands from random users after the sweeps')
+    args = parser.parse_args()
+    if args.sweeps > 1 and args.cache_ttl >= args.sweep_interval:
+        parser.error('--cache-ttl must be below --sweep-interval, later sweeps would be served from the cache')
+
+    fixture_dir = os.path.abspath(args.fixture_dir)
+    prepare_workdir(args.workdir)
+    db_file = 'sim_users_{}.sqlite'.format(args.users)
+    if not os.path.exists(db_file):
+        start = time.perf_counter()
+        generate_users(db_file, args.users, args.districts, args.pincodes)
+        print("generated {} users in {:.1f}s".format(args.users, time.perf_counter() - start))
+    with open('db_info.json', 'w') as fp:
+        json.dump({'DB_SETTINGS' : {'url' : 'sqlite:///' + os.path.abspath(db_file)}}, fp)
+
+    cowin = FakeCowinServer(fixture_dir, args.cowin_latency, args.cowin_error_rate, args.centers).start()
+    telegram = FakeTelegramServer(args.tg_latency, args.tg_error_rate).start()
+    os.environ.update({
+        'DB_INFO_FILE' : os.path.abspath('db_info.json'),
+        'COWIN_API_ROOT' : cowin.url,
+        'TELEGRAM_API_URL' : telegram.url,
+        'COWIN_TEL_BOT_KEY' : '123456:simulated',
+        'COWIN_RESPONSE_CACHE_FILE' : os.path.abspath('fetched_data/response_cache.sqlite'),
+    })
+
+    # read their settings from the environment on import
+    import broadcast
+    broadcast.SEND_SETTINGS['global_per_sec'] = args.send_rate
+    brd = broadcast.BroadCaster(max_requests_per_sec=args.fetch_rps or None, response_cache_time=args.cache_ttl)
+
+    results = []
+    for sweep in range(args.sweeps):
+        if sweep:
+            time.sleep(max(0.0, args.sweep_interval - results[-1][1]))
+        calls, msgs = cowin.calls, telegram.msgs_sent
+        start = time.perf_counter()
+        brd.push_updates(time_budget=args.time_budget or None)
+        elapsed = time.perf_counter() - start
+        results.append((sweep + 1, elapsed, cowin.calls - calls, telegram.msgs_sent - msgs))
+
+    handler_result = None
+    if args.handler_requests:
+        calls, msgs = cowin.calls, telegram.msgs_sent
+        handler_result = run_handler_load(args.handler_requests, args.users, args.cache_ttl)
+        handler_result += (cowin.calls - calls, telegram.msgs_sent - msgs)
+
+    print("\nusers {}, districts {}, pincodes {}".format(args.users, args.districts, args.pincodes))
+    for sweep, elapsed, api_calls, msgs_sent in results:
+        print("sweep {} - {:.1f}s, api calls {}, msgs sent {}, {:.1f} msgs/s".format(
+                sweep, elapsed, api_calls, msgs_sent, msgs_sent / elapsed if elapsed > 0 else 0.0))
+    if handler_result:
+        num_requests, elapsed, avg_wait, max_wait, avg_run, api_calls, msgs_sent = handler_result
+        print("/get_latest x{} - {:.1f}s, {:.1f} req/s, lane wait avg {:.3f}s max {:.3f}s, handler avg {:.3f}s, api calls {}, msgs sent {}".format(
+                num_requests, elapsed, num_requests / elapsed if elapsed > 0 else 0.0, avg_wait, max_wait, avg_run, api_calls, msgs_sent))
+    print("api errors {}, telegram errors {}".format(cowin.errors, telegram.errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Compares memory held by the parsed centers/sessions against the earlier __dict__ based objects
+#   python benchmarks/memory_compare.py [num_centers]
+import os
+import sys
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from parse_data import CowinCenter
+from payloads import make_district_payload
+
+
+class DictSession:
+    # the session object as it was before __slots__, interning and cached date parsing
+    def __init__(self, session_d):
+        self.session_id_ = session_d['session_id']
+        self.date_ = datetime.strptime(session_d['date'], "%d-%m-%Y")
+        self.vaccine_ = session_d['vaccine']
+        self.available_capacity_ = int(session_d['available_capacity'])
+        self.available_capacity_dose1_ = int(session_d['available_capacity_dose1'])
+        self.available_capacity_dose2_ = int(session_d['available_capacity_dose2'])
+        self.min_age_limit_ = int(session_d['min_age_limit'])
+
+
+class DictCenter:
+    def __init__(self, center_d):
+        block_name = center_d['block_name']
+        self.center_id_ = center_d['center_id']
+        self.name_ = center_d['name']
+        self.block_name_ = block_name if 'not applicable' not in block_name.lower() else ''
+        self.fee_type_ = center_d['fee_type']
+        self.sessions_ = [DictSession(ss) for ss in center_d['sessions']]
+
+
+def measure(build, centers_json):
+    tracemalloc.start()
+    objs = build(centers_json)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    return current, peak
+
+
+def main():
+    num_centers = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    centers_json = make_district_payload(num_centers)['centers']
+    num_sessions = sum(len(cc['sessions']) for cc in centers_json)
+
+    results = [
+        ('dict objects', measure(lambda data: [DictCenter(cc) for cc in data], centers_json)),
+        ('slots objects', measure(lambda data: list(CowinCenter.build_from_json(data)), centers_json)),
+    ]
+    print("{} centers, {} sessions".format(num_centers, num_sessions))
+    for name, (current, peak) in results:
+        print("{:15} retained {:9.1f} KiB  peak {:9.1f} KiB  ({:.0f} B/session)".format(name, current / 1024, peak / 1024, current / num_sessions))
+
+
+if __name__ == '__main__':
+    main()
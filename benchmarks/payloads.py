@@ -0,0 +1,49 @@
+import random
+from datetime import datetime, timedelta
+
+
+VACCINES = ['COVISHIELD', 'COVAXIN', 'SPUTNIK V']
+FEE_TYPES = ['Free', 'Paid']
+BLOCKS = ['Not Applicable', 'North', 'South', 'East', 'West', 'Central']
+
+
+def make_center(center_id, pincode, num_sessions, rnd, start_date):
+    sessions = []
+    for ind in range(num_sessions):
+        dose1 = rnd.choice([0, 0, 0, 2, 10, 50, 150])
+        dose2 = rnd.choice([0, 0, 5, 20])
+        sessions.append({
+            'session_id' : '%08x-%04x' % (center_id, ind),
+            'date' : (start_date + timedelta(days=ind % 7)).strftime("%d-%m-%Y"),
+            'available_capacity' : dose1 + dose2,
+            'available_capacity_dose1' : dose1,
+            'available_capacity_dose2' : dose2,
+            'min_age_limit' : rnd.choice([18, 45]),
+            'vaccine' : rnd.choice(VACCINES),
+            'slots' : ['09:00AM-11:00AM', '11:00AM-01:00PM', '01:00PM-03:00PM', '03:00PM-06:00PM'],
+        })
+    return {
+        'center_id' : center_id,
+        'name' : 'Synthetic Health Centre %d' % center_id,
+        'address' : '%d Main Road' % center_id,
+        'state_name' : 'Synthetic State',
+        'district_name' : 'Synthetic District',
+        'block_name' : rnd.choice(BLOCKS),
+        'pincode' : pincode,
+        'lat' : 12,
+        'long' : 77,
+        'from' : '09:00:00',
+        'to' : '18:00:00',
+        'fee_type' : rnd.choice(FEE_TYPES),
+        'sessions' : sessions,
+    }
+
+
+def make_district_payload(num_centers, max_sessions = 7, num_pincodes = None, seed = 0):
+    # calendarByDistrict shaped payload
+    rnd = random.Random(seed)
+    start_date = datetime(2021, 5, 10)
+    num_pincodes = num_pincodes or max(1, num_centers // 8)
+    centers = [ make_center(100000 + ind, 560000 + (ind % num_pincodes), rnd.randint(1, max_sessions), rnd, start_date)
+                    for ind in range(num_centers) ]
+    return {'centers' : centers}
@@ -1,4 +1,5 @@
 import logging
+import os
 
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
@@ -12,17 +13,24 @@ from telegram.ext import (
 from telegram import constants
 
 from bot_data_handler import BotDataHandler
+from response_store import SqliteResponseStore
+from geo_index import build_kb_layout
+from handler_lanes import HandlerLanes, LANE_SETTINGS
+from render import split_message
+from metrics import METRICS
 from emojis import EMOJIS
 
 AREA_INPUT_METHODS = ['Pincode', 'District']
+PINCODE_LENGTH = 6
 MESSAGES = {
     'welcome_message' : '''Hi,\nSend me your PINCODE & AGE and I will update you when new slots for vaccination are available in your area ''' + EMOJIS['syringe'],
-    'help' : 'Press here to /start again or update age/location\nPress here to /get_latest slot availability status\nClick here to /stop_receiving_updates and here to /resume_updates later',
+    'help' : 'Press here to /start again or update age/location\nPress here to /get_latest slot availability status\nClick here to /stop_receiving_updates and here to /resume_updates later\nFollow another area with /add_area, see yours with /my_areas and drop the added ones with /clear_areas',
     'ask_age' : 'Select the age group for which you want to receive vaccine availability updates',
     'invalid_area_type' : 'That is not a valid way to input area ' + EMOJIS['sad'] + '\nChoices are - %s'%(', '.join(AREA_INPUT_METHODS)),
     'unexpected_error' : 'Sorry, bot encountered an unexpected error, please /start again',
     'no_slots' : 'Currently no vaccinations slots are available in your area ' + EMOJIS['sad'] + ' \nStay tuned for updates',
     'invalid_age_group' : "Please provide a valid age group\nChoices are - " + ', '.join(BotDataHandler.AGE_MAPPING.keys()),
+    'stale_data' : 'CoWIN is not responding right now, showing the last data fetched for your area',
     'ask_area_type' : 'Choose an option to input your area ' +  EMOJIS['location'] + '\n\nNOTE: Selecting district will give you access to more vaccination centres updates',
 }
 
@@ -41,10 +49,39 @@ def log_deco(func):
             uname = user.first_name if user.first_name else ''
             print("<%s>"%datetime.now().strftime("%H:%M %d-%m"), "@{} -- {}<{}>:  -- {}".format(func.__name__, uname, user.id, in_msg, context) )
         return func(self, update, context, *args, **kwargs)
-        
+    new_func.__name__ = func.__name__
     return new_func
 
 
+def timed(func):
+    # per-command latency, placed innermost so handlers running in a lane are timed where they run
+    def new_func(self, update, context, *args, **kwargs):
+        with METRICS.timer('bot_command_seconds', command=func.__name__):
+            return func(self, update, context, *args, **kwargs)
+    new_func.__name__ = func.__name__
+    return new_func
+
+
+def in_lane(lane, immediate_result = None):
+    # runs the handler on one of CowinBot.lanes pools and hands `immediate_result` straight back to the dispatcher
+    def deco(func):
+        def new_func(self, update, context, *args, **kwargs):
+            self.lanes.submit(lane, func.__name__, func, self, update, context, *args, **kwargs)
+            return immediate_result
+        new_func.__name__ = func.__name__
+        return new_func
+    return deco
+
+
+BOT_SETTINGS = {
+    # connections shared by everything that calls the bot api: every lane thread replies, plus the
+    # dispatcher, update polling and ptb's own run_async workers (ptb sizes its default pool as workers + 4)
+    'request_pool_size' : sum(LANE_SETTINGS.values()) + 4 + 4,
+    'lane_report_interval' : 300,   # secs between queue wait time reports in the log
+    'api_url' : os.environ.get('TELEGRAM_API_URL'),     # bot api base url, e.g. a local stand-in for load tests
+}
+
+
 
 
 class CowinBot:
@@ -55,31 +92,45 @@ class CowinBot:
  
     
     def __init__(self, bot_token, cowin_data_handler):
+        self.bot_token = bot_token
         self.data_handler = cowin_data_handler
-        self.updater = Updater(token=bot_token, use_context=True)
+        # handlers run synchronously on the dispatcher and hand their work to self.lanes, the lane sizes
+        # (LANE_SETTINGS) are the concurrency knob, not the dispatcher's run_async workers
+        self.updater = Updater(token=bot_token, use_context=True, base_url=BOT_SETTINGS['api_url'],
+                                request_kwargs={'con_pool_size' : BOT_SETTINGS['request_pool_size']})
         self.dispatcher = self.updater.dispatcher
+        self.lanes = HandlerLanes()
 
 
-    def start_listening(self):
+    def start_listening(self, webhook_url = None, listen = '0.0.0.0', port = 8443):
         for handler in self._build_conv_handlers():
             self.dispatcher.add_handler(handler)       
         self.dispatcher.add_handler(MessageHandler(Filters.text, self._handler_for_help_implicit))
-        self.updater.start_polling()
+        self.updater.job_queue.run_repeating(lambda context: self.lanes.report(), interval=BOT_SETTINGS['lane_report_interval'])
+        if webhook_url:
+            # the token as path keeps the endpoint unguessable
+            self.updater.start_webhook(listen=listen, port=port, url_path=self.bot_token, 
+                                        webhook_url=webhook_url.rstrip('/') + '/' + self.bot_token)
+        else:
+            self.updater.start_polling()
     
 
     def _build_conv_handlers(self):
         help_cmd_handler = CommandHandler('help', self._handler_for_help)
         start_cmd_handler = CommandHandler('start', self._handler_for_start)
+        add_area_cmd_handler = CommandHandler('add_area', self._handler_for_add_area)
         
         handlers = []
         handlers.append( help_cmd_handler )
         handlers.append( CommandHandler('get_latest', self._handler_current_status))
         handlers.append( CommandHandler('stop_receiving_updates', self._handler_for_stop_updates))
         handlers.append( CommandHandler('resume_updates', self._handler_for_resume_updates))
+        handlers.append( CommandHandler('my_areas', self._handler_for_my_areas))
+        handlers.append( CommandHandler('clear_areas', self._handler_for_clear_areas))
         
-        override_cmds = [start_cmd_handler, help_cmd_handler]
+        override_cmds = [start_cmd_handler, help_cmd_handler, add_area_cmd_handler]
         conv_handler = ConversationHandler(
-            entry_points=[start_cmd_handler],
+            entry_points=[start_cmd_handler, add_area_cmd_handler],
             states = {
                 CowinBot.AREA_SELECT_METHOD: override_cmds + [MessageHandler(Filters.text, self._handler_for_area_type)],
                 CowinBot.PIN_CODE: override_cmds + [MessageHandler(Filters.text, self._handler_update_pin_code)],
@@ -95,17 +146,21 @@ class CowinBot:
         handlers.append( start_cmd_handler )
         return handlers
 
+    @timed
     def _handler_for_help(self, update, context):
         update.message.reply_text(MESSAGES['help'])
         return ConversationHandler.END  
 
     @log_deco
+    @timed
     def _handler_for_help_implicit(self, update, context):
         update.message.reply_text("I couldn't understand that. You can try below options - \n\n" + MESSAGES['help'])
         return ConversationHandler.END  
 
+    @timed
     def _handler_for_start(self, update, context):
         in_msg = update.message.text.strip() 
+        context.user_data.pop('adding_area', None)
         if in_msg == '/start' and (not context.user_data): # when its start and its new user
             update.message.reply_text(MESSAGES['welcome_message'])
         user = update.message.from_user
@@ -116,62 +171,86 @@ class CowinBot:
         return CowinBot.AREA_SELECT_METHOD
 
     @log_deco
+    @timed
+    def _handler_for_add_area(self, update, context):
+        # same conversation as /start, but the area chosen is added next to the existing ones
+        context.user_data['adding_area'] = True
+        update.message.reply_text(MESSAGES['ask_area_type'], reply_markup=CowinBot.AREA_TYPE_SELECT_KEYBOARD)
+        return CowinBot.AREA_SELECT_METHOD
+
+    @log_deco
+    @timed
     def _handler_for_area_type(self, update, context):
         area_method = update.message.text.strip().lower()
         if area_method == "pincode":
             context.user_data['area_type'] = "pincode"
-            update.message.reply_text("Enter your area pin code")
+            update.message.reply_text("Enter your area pin code (or its first few digits to see known pin codes)")
             return CowinBot.PIN_CODE
         elif area_method == "district":
             context.user_data['area_type'] = "district"
-            state_names = self.data_handler.get_states_data()['state_name_to_id'].keys()
-            kb = self.build_kb_layout(state_names)
-            update.message.reply_text("Select your State", reply_markup = ReplyKeyboardMarkup(kb, one_time_keyboard=True))
+            update.message.reply_text("Select your State", reply_markup = self.data_handler.get_geo_index().states_keyboard)
             return CowinBot.SELECT_STATE
         else:
             update.message.reply_text(MESSAGES['invalid_area_type'], reply_markup=CowinBot.AREA_TYPE_SELECT_KEYBOARD)
             return CowinBot.AREA_SELECT_METHOD
 
-    def build_kb_layout(self, keys, cols = 3):
-        keys = sorted(keys)
-        kb_layout = [ keys[ind: min(len(keys), ind + cols)] for ind in range(0, len(keys), cols) ]
-        return kb_layout
-
     @log_deco
+    @timed
     def _handler_for_select_state(self, update, context):
         state_name = update.message.text.strip()
-        state_id = self.data_handler.get_states_data()['state_name_to_id'].get(state_name, None)
+        geo_index = self.data_handler.get_geo_index()
+        state_id = geo_index.get_state_id(state_name)
         if state_id is None:
             update.message.reply_text("Please select a valid state by clicking on the keyboard")
             return CowinBot.SELECT_STATE
 
-        district_names = self.data_handler.get_states_data()['state_to_district_names'].get(state_id, None)
-        if not district_names:
+        district_kb = geo_index.get_state_keyboard(state_id)
+        if not district_kb:
             update.message.reply_text(MESSAGES['unexpected_error'])
             return ConversationHandler.END   
         
-        kb = self.build_kb_layout(district_names)
-        update.message.reply_text("Select your district", reply_markup = ReplyKeyboardMarkup(kb, one_time_keyboard=True) )
+        context.user_data['state_id'] = state_id
+        update.message.reply_text("Select your district, or type the first few letters of its name", reply_markup = district_kb)
         return CowinBot.SELECT_DISTRICT  
     @log_deco
+    @timed
     def _handler_for_select_district(self, update, context):
         district_name = update.message.text.strip()
-        district_id = self.data_handler.get_states_data()['district_name_to_id'].get(district_name, None)
+        geo_index = self.data_handler.get_geo_index()
+        state_id = context.user_data.get('state_id')
+        district_id = geo_index.get_district_id(state_id, district_name)
         if district_id is None:
-            update.message.reply_text("Please select a valid district by clicking on the keyboard")
-            return CowinBot.SELECT_DISTRICT
+            matches = geo_index.search_districts(district_name, state_id) if district_name else []
+            if len(matches) == 1:
+                _, district_id, district_name = matches[0]
+            elif matches:
+                kb = build_kb_layout([ name for _, _, name in matches ])
+                update.message.reply_text("Did you mean one of these?", reply_markup = ReplyKeyboardMarkup(kb, one_time_keyboard=True))
+                return CowinBot.SELECT_DISTRICT
+            else:
+                update.message.reply_text("Please select a valid district by clicking on the keyboard")
+                return CowinBot.SELECT_DISTRICT
         context.user_data['area_code'] = district_id
         context.user_data['area_name'] = "Dist - " + district_name
         update.message.reply_text(MESSAGES['ask_age'], reply_markup=CowinBot.AGE_KEYBOARD)
         return CowinBot.AGE
     
     @log_deco
+    @timed
     def _handler_update_pin_code(self, update, context):
         pin_code_str = update.message.text.strip()
         print("update_pin_code", pin_code_str)
         if not pin_code_str.isdigit():
             update.message.reply_text("Please provide a valid pin_code")
             return CowinBot.PIN_CODE
+        if len(pin_code_str) < PINCODE_LENGTH:
+            matches = self.data_handler.get_geo_index().search_pincodes(pin_code_str, limit = 12)
+            if matches:
+                update.message.reply_text("Pin codes starting with {}".format(pin_code_str), 
+                                            reply_markup = ReplyKeyboardMarkup(build_kb_layout(matches), one_time_keyboard=True))
+            else:
+                update.message.reply_text("Please provide the full {} digit pin_code".format(PINCODE_LENGTH))
+            return CowinBot.PIN_CODE
         pin_code = int(pin_code_str)
         context.user_data['area_name'] = "Pincode - " + str(pin_code)
         context.user_data['area_code'] = pin_code
@@ -180,6 +259,7 @@ class CowinBot:
 
 
     @log_deco
+    @timed
     def _handler_update_age(self, update, context):  
         user_id = update.effective_chat.id
         age_str = update.message.text.strip()
@@ -194,9 +274,13 @@ class CowinBot:
         print("DATAA --- ", context.user_data)
         user = update.message.from_user
         area_name = context.user_data['area_name']
-        self.data_handler.add_user(user, context.user_data)
         age_msg_str = self.data_handler.get_age_str(age_str)
-        update.message.reply_text("Will notify you when slots are available in your location %s, for %s age group %s"%(area_name, age_msg_str, EMOJIS['thumbs_up']))
+        if context.user_data.pop('adding_area', False):
+            self.data_handler.add_subscription(user, context.user_data)
+            update.message.reply_text("Will also notify you when slots are available in %s, for %s age group %s"%(area_name, age_msg_str, EMOJIS['thumbs_up']))
+        else:
+            self.data_handler.add_user(user, context.user_data)
+            update.message.reply_text("Will notify you when slots are available in your location %s, for %s age group %s"%(area_name, age_msg_str, EMOJIS['thumbs_up']))
         
         reply_keyboard = [[EMOJIS['thumbs_up'], 'Nope']]
 
@@ -207,7 +291,9 @@ class CowinBot:
         return CowinBot.FETCH_CURRENT
 
 
+    @in_lane('slow', ConversationHandler.END)
     @log_deco
+    @timed
     def _handler_current_status(self, update, context):
         if update.message.text.strip() not in [EMOJIS['thumbs_up'], '/get_latest']:
             update.message.reply_text("Done " + EMOJIS['thumbs_up'] +'\n\n' + MESSAGES['help'])
@@ -216,7 +302,9 @@ class CowinBot:
         user_id = update.effective_chat.id
 
         try:
-            centers, no_vaccine_msg = self.data_handler.get_vaccine_centers_for_user(user_id)
+            centers, no_vaccine_msg, is_stale = self.data_handler.get_vaccine_centers_for_user(user_id)
+            if is_stale:
+                update.message.reply_text(MESSAGES['stale_data'])
             if no_vaccine_msg:
                 msg = no_vaccine_msg + ' ' + EMOJIS['sad']
             elif centers:
@@ -241,41 +329,44 @@ class CowinBot:
         # )
         # return CowinBot.FETCH_CURRENT
 
+    @in_lane('fast')
     @log_deco
+    @timed
     def _handler_for_stop_updates(self, update, context):  
         user_id = update.effective_chat.id
         self.data_handler.stop_update_for_user(user_id)
         update.message.reply_text("Updates are now paused for you. Can resume by /resume_updates")
 
+    @in_lane('fast')
     @log_deco
+    @timed
     def _handler_for_resume_updates(self, update, context):  
         user_id = update.effective_chat.id
         self.data_handler.resume_update_for_user(user_id)
         update.message.reply_text("You will start getting updates now")
 
-
-def send_message(text, sender_func):
-    if len(text) <= constants.MAX_MESSAGE_LENGTH:
-        return sender_func(text)
-
-    parts = []
-    while len(text) > 0:
-        if len(text) > constants.MAX_MESSAGE_LENGTH:
-            part = text[:constants.MAX_MESSAGE_LENGTH]
-            first_lnbr = part.rfind('\n')
-            if first_lnbr != -1:
-                parts.append(part[:first_lnbr])
-                text = text[first_lnbr:]
-            else:
-                parts.append(part)
-                text = text[constants.MAX_MESSAGE_LENGTH:]
+    @in_lane('fast')
+    @log_deco
+    @timed
+    def _handler_for_my_areas(self, update, context):
+        subs = self.data_handler.get_subscription_strs(update.effective_chat.id)
+        if subs:
+            update.message.reply_text("You get updates for\n" + '\n'.join(subs))
         else:
-            parts.append(text)
-            break
+            update.message.reply_text("You haven't picked an area yet, press /start")
 
+    @in_lane('fast')
+    @log_deco
+    @timed
+    def _handler_for_clear_areas(self, update, context):
+        num_removed = self.data_handler.clear_extra_subscriptions(update.effective_chat.id)
+        update.message.reply_text("Removed {} added area{}. Use /start to change your main area".format(num_removed, '' if num_removed == 1 else 's'))
+
+
+def send_message(text, sender_func):
     msg = None
-    for part in parts:
-        sender_func(part)
+    for part in split_message([text], constants.MAX_MESSAGE_LENGTH):
+        msg = sender_func(part)
     return msg  # return only the last message
 
 
@@ -290,8 +381,10 @@ if __name__ == '__main__':
         DBG_LVL = 'DBG'
     
     if token is not None:
-        data_handler = BotDataHandler(response_cache_time=120)
+        METRICS.start()
+        data_handler = BotDataHandler(response_cache_time=120, shared_cache_file=SqliteResponseStore.DEFAULT_FILE)
         bot = CowinBot(token, data_handler)
-        bot.start_listening()
+        # webhook mode when a public url is given, long polling otherwise
+        bot.start_listening(webhook_url=os.environ.get('COWIN_WEBHOOK_URL'), port=int(os.environ.get('PORT', 8443)))
     else:
         logging.critical("BOT token not found in env var - COWIN_TEL_BOT_KEY")
\ No newline at end of file
@@ -1,16 +1,31 @@
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 
 from fetch_cowin_data import CowinDataConnector
-from parse_data import CowinCenter, CowinCenterSession
+from parse_data import CowinCenterSession, AreaSnapshot
 import json
 
 from sqlalchemy import create_engine
-from sqlalchemy import select
-from sqlalchemy.orm import sessionmaker 
-from db_models import User, UserActivity, AreaUpdate, get_db_login_info
+from sqlalchemy import select, update
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.dialects import mysql, sqlite
+from db_models import User, Subscription, UserActivity, AreaUpdate, get_db_login_info
+from subscription_index import SubscriptionIndex
+from response_store import SqliteResponseStore
+from geo_index import GeoIndex
+from render import split_message
+
+from collections import defaultdict, Counter
 
-from collections import defaultdict
+
+DB_POOL_SETTINGS = {
+    'pool_size' : 10,           # connections kept open
+    'max_overflow' : 20,        # extra connections allowed under bursts
+    'pool_timeout' : 30,        # secs to wait for a free connection
+    'pool_pre_ping' : True,     # drop connections the server closed while idle
+    'pool_recycle' : 1800,      # secs, stays below mysql's wait_timeout
+}
 
 
 class BotDataHandler:
@@ -18,37 +33,123 @@ class BotDataHandler:
     AGE_MAPPING = dict(AGE_MAPPING_IN_ORDER)
     REV_AGE_MAPPING = { val:key for key, val in AGE_MAPPING.items()}
 
-    def __init__(self, response_cache_time):
+    def __init__(self, response_cache_time, max_requests_per_sec = None, http_pool_size = 10, shared_cache_file = None):
         db_login_info = get_db_login_info()
-        host, db_name, user_name, password = db_login_info['host'], db_login_info['name'], db_login_info['username'], db_login_info['password']
-        engine = create_engine("mysql+pymysql://{}:{}@{}/{}?charset=utf8mb4".format(user_name, password, host, db_name))
+        if 'url' in db_login_info:
+            # any sqlalchemy url, e.g. the sqlite db built by benchmarks/gen_users.py
+            engine = create_engine(db_login_info['url'])
+        else:
+            host, db_name, user_name, password = db_login_info['host'], db_login_info['name'], db_login_info['username'], db_login_info['password']
+            # optional "pool" section in DB_SETTINGS overrides DB_POOL_SETTINGS
+            pool_settings = dict(DB_POOL_SETTINGS, **db_login_info.get('pool', {}))
+            engine = create_engine("mysql+pymysql://{}:{}@{}/{}?charset=utf8mb4".format(user_name, password, host, db_name), **pool_settings)
     
-        self.db_session = sessionmaker(bind=engine)()
-
-        self.data_conn = CowinDataConnector(response_cache_time=response_cache_time)
+        self.engine = engine
+        # every thread gets its own session, bot handlers use short lived ones through session_scope()
+        self.db_session = scoped_session(sessionmaker(bind=engine))
+        self.subscription_index = None
+        self.geo_index = None
+        self.processed_data_versions = {}   # (area_code, is_pincode, age_grp) -> payload version of the last committed broadcaster sweep
+        self.pending_data_versions = {}     # versions handed out in the current sweep, kept with commit_db_session
+
+        shared_cache = SqliteResponseStore(shared_cache_file) if shared_cache_file else None
+        self.data_conn = CowinDataConnector(response_cache_time=response_cache_time, pool_size=http_pool_size, 
+                                            max_requests_per_sec=max_requests_per_sec, shared_cache=shared_cache)
         
 
+    @contextmanager
+    def session_scope(self):
+        # per request session: commits on success, and hands its connection back to the pool when done
+        session = self.db_session()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            self.db_session.remove()
+
+
     def add_user(self, user, user_data):
         fname = (user.first_name if user.first_name else '') + ' ' + (user.last_name if user.last_name else '')
         uname = user.username if user.username else ''
         age = BotDataHandler.AGE_MAPPING.get(user_data['age'], BotDataHandler.AGE_MAPPING['All Age groups'])
-        self.db_session.merge(User(user_id = user.id, uname = uname, fname = fname, 
-                                    area_type = user_data['area_type'], area_code = user_data['area_code'], age_group = age, is_subscribed = True))
-        self.db_session.commit()
+        with self.session_scope() as session:
+            session.merge(User(user_id = user.id, uname = uname, fname = fname, 
+                                area_type = user_data['area_type'], area_code = user_data['area_code'], age_group = age, is_subscribed = True))
+        self._update_subscription_index(user.id, user_data['area_type'], user_data['area_code'], age, True)
 
 
+    def add_subscription(self, user, user_data):
+        # an extra area for an existing user, a new user gets it as the primary one in `users`
+        age = BotDataHandler.AGE_MAPPING.get(user_data['age'], BotDataHandler.AGE_MAPPING['All Age groups'])
+        area_type, area_code = user_data['area_type'], str(user_data['area_code'])
+        with self.session_scope() as session:
+            if session.query(User).get(user.id) is None:
+                is_new_user = True
+            else:
+                is_new_user = False
+                sub = session.query(Subscription).filter_by(user_id = user.id, area_type = area_type, area_code = area_code, age_group = age).first()
+                if sub is None:
+                    session.add(Subscription(user_id = user.id, area_type = area_type, area_code = area_code, age_group = age, is_active = True))
+                else:
+                    sub.is_active = True
+        if is_new_user:
+            return self.add_user(user, user_data)
+        if self.subscription_index is not None:
+            self.subscription_index.apply_extra(user.id, area_type, area_code, age, True)
+
+    def clear_extra_subscriptions(self, user_id):
+        with self.session_scope() as session:
+            subs = session.query(Subscription).filter_by(user_id = user_id, is_active = True).all()
+            removed = [ (sub.area_type, sub.area_code, sub.age_group) for sub in subs ]
+            for sub in subs:
+                sub.is_active = False
+        if self.subscription_index is not None:
+            for area_type, area_code, age_group in removed:
+                self.subscription_index.apply_extra(user_id, area_type, area_code, age_group, False)
+        return len(removed)
+
+    def get_subscription_strs(self, user_id):
+        with self.session_scope() as session:
+            user = session.query(User).get(user_id)
+            if user is None:
+                return []
+            subs = [ (user.area_type, user.area_code, user.age_group) ]
+            subs += [ (sub.area_type, sub.area_code, sub.age_group) for sub in session.query(Subscription).filter_by(user_id = user_id, is_active = True) ]
+        return [ '{}, {}'.format(self.get_area_str(area_code, area_type), self.get_age_str2(age_group)) for area_type, area_code, age_group in subs ]
+
     def stop_update_for_user(self, user_id):
-        user = self.db_session.query(User).get(user_id)
-        if (user is not None) and user.is_subscribed == True:
-            user.is_subscribed = False
-            self.db_session.commit()
+        self._set_subscription(user_id, False)
 
 
     def resume_update_for_user(self, user_id):
-        user = self.db_session.query(User).get(user_id)
-        if (user is not None) and user.is_subscribed == False:
-            user.is_subscribed = True
-            self.db_session.commit()
+        self._set_subscription(user_id, True)
+
+    def _set_subscription(self, user_id, is_subscribed):
+        with self.session_scope() as session:
+            user = session.query(User).get(user_id)
+            if (user is None) or user.is_subscribed == is_subscribed:
+                return
+            user.is_subscribed = is_subscribed
+            area_type, area_code, age_group = user.area_type, user.area_code, user.age_group
+        self._update_subscription_index(user_id, area_type, area_code, age_group, is_subscribed)
+
+    def unsubscribe_users(self, user_ids, chunk_size = 1000):
+        # users the broadcaster can't reach any more (blocked the bot, chat gone), /resume_updates turns them back on
+        user_ids = list(user_ids)
+        for ind in range(0, len(user_ids), chunk_size):
+            self.db_session.execute(update(User).where(User.user_id.in_(user_ids[ind: ind + chunk_size])).where(User.is_subscribed == True)
+                                        .values(is_subscribed = False).execution_options(synchronize_session = False))
+        self.db_session.commit()
+        for user_id in user_ids:
+            self._update_subscription_index(user_id, None, None, None, False)
+
+    def _update_subscription_index(self, user_id, area_type, area_code, age_group, is_subscribed):
+        # changes made from other processes are picked up by SubscriptionIndex.refresh
+        if self.subscription_index is not None:
+            self.subscription_index.apply(user_id, area_type, area_code, age_group, is_subscribed)
 
     def get_area_str(self, area_code, area_type):
         area_code = int(area_code)
@@ -58,17 +159,21 @@ class BotDataHandler:
             return self.get_states_data()['district_id_to_name'].get(area_code, '[district] %d'%area_code)
 
     def get_vaccine_centers_for_user(self, user_id):
-        user = self.db_session.query(User).get(user_id)
-        if user is None:
-            raise Exception("User doesn't exist")  # handled later?
-
-        area_code = user.area_code
-        area_type = user.area_type
-        age = user.age_group
-        print("--------", user)
-        api_data = self.data_conn.fetch_data(area_code, datetime.now(), area_type == "pincode")
+        with self.session_scope() as session:
+            user = session.query(User).get(user_id)
+            if user is None:
+                raise Exception("User doesn't exist")  # handled later?
+
+            area_code = user.area_code
+            area_type = user.area_type
+            age = user.age_group
+            print("--------", user)
+        # the connection is back in the pool before waiting on the CoWIN API
+        now = datetime.now()
+        api_data = self.data_conn.fetch_data(area_code, now, area_type == "pincode")
+        is_stale = self.data_conn.is_stale(area_code, now, area_type == "pincode")
         if api_data:
-            centers = list( CowinCenter.build_and_get_filtered_centers(api_data.get("centers", []), age, 1) )
+            centers = AreaSnapshot.build_from_json(api_data.get("centers", [])).get_filtered_centers(age, 1)
         else:
             centers = None
 
@@ -76,56 +181,154 @@ class BotDataHandler:
         if centers is not None and len(centers) == 0:
             # no vaccination centers
             no_vaccine_msg = 'Currently no vaccination slots are available in {} for age group {}'.format(self.get_area_str(area_code, area_type), self.get_age_str2(age))
-        return centers, no_vaccine_msg
+        return centers, no_vaccine_msg, is_stale
 
 
-    def get_filtered_data_for_location(self, age_groups, area_code, is_pincode, slot_threshold = 1):
-        api_data = self.data_conn.fetch_data(area_code, datetime.now(), is_pincode)
-        if not api_data:
-            return None
-        
+    def plan_area_fetches(self, areas):
+        # pincodes whose district is known are answered from the district response instead of a separate calendarByPin call
+        fetch_plan = defaultdict(list)
+        for area_code, is_pincode in areas:
+            district_ids = self.data_conn.pincode_index.get_districts(area_code) if is_pincode else []
+            if district_ids:
+                for district_id in district_ids:
+                    fetch_plan[(str(district_id), False)].append((area_code, True))
+            else:
+                fetch_plan[(str(area_code), is_pincode)].append((area_code, is_pincode))
+        return fetch_plan
+
+
+    def get_filtered_data_for_locations(self, area_to_age_groups, slot_threshold = 1, max_workers = 8, deadline = None, failed_areas = None):
+        # area_to_age_groups - { (area_code, is_pincode) : age_groups }, fetched in dict order and yielded as each fetch completes.
+        # centers is None when the payload is byte-identical to the one last yielded for that area and age group.
+        # Areas whose fetch failed are not yielded, they are added to failed_areas (a set) if given
+        fetch_plan = self.plan_area_fetches(area_to_age_groups.keys())
+        # a pincode with centres in several districts is answered once all of them are in, from their centres together
+        num_sources = Counter( served_area for served_areas in fetch_plan.values() for served_area in served_areas )
+        partial = defaultdict(list)     # served area -> [(centers or None, version)] from its districts fetched so far
+        for area_code, is_pincode, api_data, version in self.data_conn.fetch_data_for_areas(fetch_plan.keys(), datetime.now(), max_workers, deadline):
+            parsed = []     # the response is parsed at most once, and only if some served area needs it
+            def get_response_snapshot(api_data = api_data, parsed = parsed):
+                if not parsed:
+                    parsed.append(AreaSnapshot.build_from_json(api_data.get("centers", [])))
+                return parsed[0]
+
+            for served_area in fetch_plan[(area_code, is_pincode)]:
+                served_code, served_is_pincode = served_area
+                age_groups = area_to_age_groups.get(served_area, [])
+                if num_sources[served_area] > 1:
+                    parts = partial[served_area]
+                    parts.append((get_response_snapshot().for_pincode(served_code).centers_ if api_data else None, version))
+                    if len(parts) < num_sources[served_area]:
+                        continue
+                    del partial[served_area]
+                    if any(centers is None for centers, _ in parts):
+                        # rather than report the centres of only some of its districts
+                        if failed_areas is not None:
+                            failed_areas.add(served_area)
+                        continue
+                    versions = [ part_version for _, part_version in parts ]
+                    merged = AreaSnapshot(list({ center.center_id_ : center for centers, _ in parts for center in centers }.values()))
+                    yield from self._filter_area_data(served_area, age_groups, tuple(sorted(versions)) if None not in versions else None,
+                                                        lambda merged = merged : merged, slot_threshold)
+                elif api_data:
+                    if served_is_pincode and not is_pincode:
+                        get_snapshot = lambda served_code = served_code : get_response_snapshot().for_pincode(served_code)
+                    else:
+                        get_snapshot = get_response_snapshot
+                    yield from self._filter_area_data(served_area, age_groups, version, get_snapshot, slot_threshold)
+                elif failed_areas is not None:
+                    failed_areas.add(served_area)
+
+    def _filter_area_data(self, served_area, age_groups, version, get_snapshot, slot_threshold):
+        # centers is None for age groups whose payload version was already handed out
+        served_code, served_is_pincode = served_area
+        served_snapshot = None
         for age_grp in age_groups:
-            centers = list( CowinCenter.build_and_get_filtered_centers(api_data.get("centers", []), age_grp, slot_threshold) )
-            yield (age_grp, centers)
+            version_key = (served_code, served_is_pincode, age_grp)
+            if version is not None and self.processed_data_versions.get(version_key) == version:
+                yield (served_code, served_is_pincode, age_grp, None)
+                continue
+            if served_snapshot is None:
+                served_snapshot = get_snapshot()
+            yield (served_code, served_is_pincode, age_grp, served_snapshot.get_filtered_centers(age_grp, slot_threshold))
+            self.pending_data_versions[version_key] = version
+
+
+    def save_pincode_index(self):
+        self.data_conn.pincode_index.save()
 
 
     def get_states_data(self):
         return self.data_conn.get_states_data()
 
+    def get_geo_index(self):
+        # rebuilt only when the states catalogue is swapped or new pincodes were learned
+        states_data = self.get_states_data()
+        num_pincodes = len(self.data_conn.pincode_index.pincode_to_districts)
+        geo_index = self.geo_index
+        if geo_index is None or geo_index.states_data is not states_data or geo_index.num_pincodes != num_pincodes:
+            geo_index = self.geo_index = GeoIndex(states_data, self.data_conn.pincode_index.get_pincodes())
+        return geo_index
+
+    def get_api_health(self):
+        return self.data_conn.get_health()
+
     def get_dist_code_to_name_from_disk(self):
         data = self.data_conn.fetch_states_and_districts_from_disk()
         if data is not None:
             return data['district_id_to_name']
 
     def segregate_user_groups(self):
-        users = self.db_session.query(User).filter_by(is_subscribed=True)
-
-        #age_gps = BotDataHandler.AGE_MAPPING.values()
-        dist_to_age_to_user_ids = defaultdict( lambda : defaultdict(list) )
-        pincode_to_age_to_user_ids = defaultdict( lambda : defaultdict(list) )
-        for uu in users:
-            user_id = uu.user_id
-            area_type = uu.area_type
-            area_code = uu.area_code
-            age_group = int(uu.age_group)
-            if area_type == 'pincode':
-                pincode_to_age_to_user_ids[area_code][age_group].append(user_id)
+        if self.subscription_index is None:
+            self.subscription_index = SubscriptionIndex()
+            self.subscription_index.load(self.db_session)
+        else:
+            self.db_session.commit()    # start a fresh transaction so changes from the bot process are visible
+            self.subscription_index.refresh(self.db_session)
+        return self.subscription_index.segregate_user_groups()
+
+    def is_subscribed_to(self, user_id, area_type, area_code, age_group):
+        # as of the last segregate_user_groups
+        if self.subscription_index is None:
+            return False
+        return (area_type, str(area_code), int(age_group)) in self.subscription_index.get_subscriptions(user_id)
+
+    def update_broadcast_count_for_users(self, user_ids, chunk_size = 1000):
+        # user_ids can repeat (one entry per broadcast received), counts are applied as multi-row upserts
+        # and committed per chunk, so calling this incrementally during a sweep keeps the counts already sent
+        user_to_count = Counter(user_ids)
+        if not user_to_count:
+            return
+        now = datetime.now()
+        rows = [ {'user_id' : user_id, 'broadcast_msg_count' : count, 'last_broadcast_time' : now} for user_id, count in user_to_count.items() ]
+        dialect = self.engine.dialect.name
+        for ind in range(0, len(rows), chunk_size):
+            chunk = rows[ind: ind + chunk_size]
+            if dialect == 'mysql':
+                stmt = mysql.insert(UserActivity.__table__).values(chunk)
+                stmt = stmt.on_duplicate_key_update(
+                        broadcast_msg_count = UserActivity.__table__.c.broadcast_msg_count + stmt.inserted.broadcast_msg_count,
+                        last_broadcast_time = stmt.inserted.last_broadcast_time)
+            elif dialect == 'sqlite':
+                stmt = sqlite.insert(UserActivity.__table__).values(chunk)
+                stmt = stmt.on_conflict_do_update(index_elements = ['user_id'], set_ = {
+                        'broadcast_msg_count' : UserActivity.__table__.c.broadcast_msg_count + stmt.excluded.broadcast_msg_count,
+                        'last_broadcast_time' : stmt.excluded.last_broadcast_time })
             else:
-                dist_to_age_to_user_ids[area_code][age_group].append(user_id)
-
-            
-        return dist_to_age_to_user_ids, pincode_to_age_to_user_ids
+                self._update_broadcast_count_per_user(chunk)
+                continue
+            self.db_session.execute(stmt)
+            self.db_session.commit()
 
 
-    def update_broadcast_count_for_users(self, user_ids):
-        for user_id in user_ids:
-            user = self.db_session.query(UserActivity).get(user_id)
+    def _update_broadcast_count_per_user(self, rows):
+        for row in rows:
+            user = self.db_session.query(UserActivity).get(row['user_id'])
             if not user:
-                user = UserActivity(user_id = user_id, broadcast_msg_count = 1, last_broadcast_time = datetime.now())
-                self.db_session.add(user)
+                self.db_session.add(UserActivity(**row))
             else:
-                user.last_broadcast_time = datetime.now()
-                user.broadcast_msg_count += 1
+                user.last_broadcast_time = row['last_broadcast_time']
+                user.broadcast_msg_count += row['broadcast_msg_count']
         self.db_session.commit()
 
 
@@ -137,25 +340,32 @@ class BotDataHandler:
             self.db_session.add(area_rec)
         return area_rec
 
+    def get_area_activity(self):
+        # (area_code, is_pincode, age_gp) -> when an update was last sent for it, without loading the fingerprints
+        rows = self.db_session.query(AreaUpdate.area_type, AreaUpdate.area_code, AreaUpdate.age_gp, AreaUpdate.last_update_time)
+        return { (area_code, area_type == 'pincode', age_gp) : last_update_time for area_type, area_code, age_gp, last_update_time in rows
+                    if last_update_time is not None }
+
     def update_area_rec(self, area_rec, area_update_summary):
         area_rec.last_update_time = datetime.now()
         area_rec.last_update = area_update_summary
 
+    def update_area_fingerprint(self, area_rec, fingerprint_blob):
+        area_rec.last_fingerprint = fingerprint_blob
+
     @staticmethod
     def get_chunked_msg_text(items, max_len):
-        if not items:
-            return []
-        chunks = [str(items[0])]
-        for item in items[1:]:
-            ss = str(item)
-            if (len(chunks[-1]) + len(ss) + 3)>= max_len:
-                chunks.append(ss)
-            else:
-                chunks[-1] = chunks[-1] + '\n' + ss
-        return chunks
+        return split_message(items, max_len)
 
     def commit_db_session(self):
         self.db_session.commit()
+        # only now that the fingerprints they led to are stored, a failed sweep sees the same payloads again
+        self.processed_data_versions.update(self.pending_data_versions)
+        self.pending_data_versions.clear()
+
+    def rollback_db_session(self):
+        self.db_session.rollback()
+        self.pending_data_versions.clear()
 
     def get_age_str(self, age):
         return str(age).lower().replace('groups', '').replace('group', '').replace('age','').title().strip()
@@ -1,8 +1,21 @@
 from bot_data_handler import BotDataHandler
 from datetime import datetime
+from collections import defaultdict
 import os
+import sys
+import time
+import logging
 
 from telegram import Bot, constants
+from telegram.utils.request import Request
+from fanout import TelegramFanOut, TELEGRAM_LIMITS
+from digest import DigestBuilder
+from coalescer import NotificationCoalescer
+from outbound_queue import OutboundQueue, is_fatal_send_error
+from poll_scheduler import AdaptivePollSchedule, SweepPlanner, SWEEP_SETTINGS
+from change_detection import AreaFingerprint
+from response_store import SqliteResponseStore
+from metrics import METRICS
 
 MESSAGES = {
     'stop_resume_updates' : 'Click here to /stop_receiving_updates\nYou can later /resume_updates',
@@ -11,36 +24,52 @@ MESSAGES = {
 }
 
 ONE_HR_IN_SECS = 60 * 60
-THREE_QUATERS_OF_AN_HOUR = 45 * 60
-
-BROADCAST_THRESHOLDS = {
-    'centers' : {
-        'percentage' : 10.0,
-        'abs_diff' : 2
-    },
-    'slots' : {
-        'percentage' : 20.0,
-        'abs_diff' : 50
-    },
+
+FETCH_SETTINGS = {
+    'max_workers' : 8,              # concurrent area fetches
+    'max_requests_per_sec' : 5,     # cap on requests hitting the CoWIN API
+    'response_cache_time' : 30,     # secs, oldest response (own or from the shared store) a one-shot run will use instead of fetching
+}
+
+SEND_SETTINGS = {
+    'max_workers' : 8,              # concurrent telegram sends
+    'record_interval' : 5,          # secs, how often delivery results are written to the outbound queue while sending
+    'global_per_sec' : TELEGRAM_LIMITS['global_per_sec'],
+    'api_url' : os.environ.get('TELEGRAM_API_URL'),     # bot api base url, e.g. a local stand-in for load tests
+}
+
+DAEMON_SETTINGS = {
+    'tick_secs' : 30,               # how often the daemon looks for (area, age) items that are due
+    'response_cache_time' : 30,     # must stay below POLL_SETTINGS['min_interval'] so polls see fresh data
+    'sweep_budget' : 25,            # secs, keeps a sweep inside its tick, deferred items get a higher score next tick
+    'coalesce_window' : int(os.environ.get('COWIN_COALESCE_WINDOW', 120)),     # secs, at most one message per user per window, 0 to send at once
 }
 
 def log_msg(msg):
     print("<%s>  %s"%(datetime.now().strftime("%H:%M %d-%m"), msg))
 
 class BroadCaster:
-    def __init__(self):
+    def __init__(self, max_fetch_workers = FETCH_SETTINGS['max_workers'], max_requests_per_sec = FETCH_SETTINGS['max_requests_per_sec'], 
+                    response_cache_time = FETCH_SETTINGS['response_cache_time']):
         token = os.environ.get('COWIN_TEL_BOT_KEY')
         if token is None:
             raise Exception("Bot token not available, can't proceed")
-        self.data_handler = BotDataHandler(response_cache_time=3600)
-        self.bot = Bot(token)
+        self.max_fetch_workers = max_fetch_workers
+        self.data_handler = BotDataHandler(response_cache_time=response_cache_time, max_requests_per_sec=max_requests_per_sec, 
+                                            http_pool_size=max_fetch_workers, shared_cache_file=SqliteResponseStore.DEFAULT_FILE)
+        self.num_send_workers = SEND_SETTINGS['max_workers']
+        self.bot = Bot(token, base_url=SEND_SETTINGS['api_url'], request=Request(con_pool_size=self.num_send_workers + 2))
 
         self.dist_code_to_name = self.data_handler.get_dist_code_to_name_from_disk()
+        self.sweep_planner = SweepPlanner()
+        self.coalescer = NotificationCoalescer(window=0)    # one-shot runs send everything they find
+        self.outbox = OutboundQueue(self.data_handler.db_session, self.data_handler.engine)
 
     def get_slot_count(self, centers):
-        all_dose = sum( sum(ss.available_capacity_ for ss in center.sessions_) for center in centers )
-        dose1 = sum( sum(ss.available_capacity_dose1_ for ss in center.sessions_) for center in centers )
-        dose2 = sum( sum(ss.available_capacity_dose2_ for ss in center.sessions_) for center in centers )
+        # per-center totals are computed once when the area snapshot is parsed
+        all_dose = sum(center.available_capacity_ for center in centers)
+        dose1 = sum(center.available_capacity_dose1_ for center in centers)
+        dose2 = sum(center.available_capacity_dose2_ for center in centers)
         return { 'all': all_dose, 'd1' : dose1, 'd2' : dose2 }
 
     def summarize(self, slot_count, num_centers, age, area_code, is_pincode):
@@ -55,102 +84,251 @@ class BroadCaster:
         return msg
 
     def get_few_from_top(self, centers, limit):
-        centers = sorted(centers, key = lambda ct: -sum(ss.available_capacity_ for ss in ct.sessions_) )
+        centers = sorted(centers, key = lambda ct: -ct.available_capacity_)
         return centers[:min(limit, len(centers))]
 
 
-    def build_msg_in_chunks(self, summary_msg, centers):
+    def build_update_section(self, summary_msg, centers):
+        # centers - only the centres that changed since the last check. Returns (items, truncated)
         MAX_CENTERS_IN_MSG = 5
         can_send_all_data_now = (len(centers) <= MAX_CENTERS_IN_MSG)
 
         items  = [summary_msg + '\n\n']
         items += centers if can_send_all_data_now else self.get_few_from_top(centers, MAX_CENTERS_IN_MSG)
         items += ["\n"]
-        items += ["These are the top {} among {} centers".format(MAX_CENTERS_IN_MSG, len(centers))]  if (not can_send_all_data_now) else [] 
-        items += [MESSAGES['view_complete']] if (not can_send_all_data_now) else [MESSAGES['view_updated']]
-        items += ['\n\n' + MESSAGES['stop_resume_updates']]
+        items += ["These are the top {} among {} centres with new slots".format(MAX_CENTERS_IN_MSG, len(centers))]  if (not can_send_all_data_now) else [] 
+        return items, not can_send_all_data_now
+
+    def get_digest_footer(self, truncated):
+        return [MESSAGES['view_complete'] if truncated else MESSAGES['view_updated'], '\n\n' + MESSAGES['stop_resume_updates']]
 
-        return self.data_handler.get_chunked_msg_text(items, constants.MAX_MESSAGE_LENGTH)
+    def build_msg_in_chunks(self, summary_msg, centers):
+        items, truncated = self.build_update_section(summary_msg, centers)
+        return self.data_handler.get_chunked_msg_text(items + self.get_digest_footer(truncated), constants.MAX_MESSAGE_LENGTH)
 
     def get_area_update_summary(self, centers):
         slot_count = self.get_slot_count(centers)['all']
         return "S:{},C:{}".format(slot_count, len(centers))
 
-    def get_slots_and_centre_count_from_summary(self, summary):
-        count_slot, count_centres = summary.split(',')
-        count_slot, count_centres = int(count_slot[2:]), int(count_centres[2:])
-        return count_slot, count_centres
-
-
     def check_if_center_have_more_than_one_slot(self, centers):
-        return any( sum(ss.available_capacity_ for ss in center.sessions_) > 1 for center in centers)
+        return any(center.available_capacity_ > 1 for center in centers)
 
-    def is_to_send_update(self, area_rec, area_update_summary, centers):
-        if (not area_rec.last_update_time):
-            return True
+    def is_to_send_update(self, delta, centers):
         if not self.check_if_center_have_more_than_one_slot(centers):
             return False
-        if ((datetime.now() - area_rec.last_update_time).seconds >= THREE_QUATERS_OF_AN_HOUR): 
-            return True
-        if (not area_rec.last_update): 
-            return True
-
-        prev_count_slot, prev_count_centres = self.get_slots_and_centre_count_from_summary(area_rec.last_update)
-        count_slot, count_centres = self.get_slots_and_centre_count_from_summary(area_update_summary)
+        return bool(delta)
 
-        percentage_increase  = lambda x, y: (x-y)*1.0/y
-        if percentage_increase(count_centres, prev_count_centres) >= BROADCAST_THRESHOLDS['centers']['percentage']:
-            if (count_centres - prev_count_centres) >= BROADCAST_THRESHOLDS['centers']['abs_diff']:
-                return True
+    def prioritize(self, area_to_age_groups, area_to_age_wise_users):
+        # reorders areas (and age groups within them) by the best score among their items, highest first
+        area_activity = self.data_handler.get_area_activity()
+        items = {}
+        for (area_code, is_pincode), age_groups in area_to_age_groups.items():
+            for age_gp in age_groups:
+                key = (area_code, is_pincode, age_gp)
+                last_activity = area_activity.get(key)
+                items[key] = (len(area_to_age_wise_users[(area_code, is_pincode)][age_gp]),
+                                last_activity.timestamp() if last_activity is not None else None)
+        # against every subscribed item, items not due this tick keep their last check time
+        self.sweep_planner.prune( (area_code, is_pincode, age_gp) for (area_code, is_pincode), age_wise_users in area_to_age_wise_users.items()
+                                    for age_gp in age_wise_users )
+        ordered = defaultdict(list)
+        for area_code, is_pincode, age_gp in self.sweep_planner.order(items):
+            ordered[(area_code, is_pincode)].append(age_gp)
+        return ordered
 
-        if percentage_increase(count_slot, prev_count_slot) >= BROADCAST_THRESHOLDS['slots']['percentage']:
-            if (count_slot - prev_count_slot) >= BROADCAST_THRESHOLDS['slots']['abs_diff']:
-                return True
-
-        return False
+    def queue_pending(self):
+        # writes the message of every user whose pending updates changed to the outbound queue, due when their
+        # coalescing window is over. Returns the number of messages queued
+        key_to_users, changed, released = self.coalescer.pop_changes()
+        digest = DigestBuilder()
+        has_sections = set()
+        for (area_code, is_pincode, age_gp), (area, user_ids) in key_to_users.items():
+            area_type = 'pincode' if is_pincode else 'district'
+            if self.coalescer.window:
+                # the user may have stopped updates or dropped the area while the message was held
+                user_ids = [ user_id for user_id in user_ids if self.data_handler.is_subscribed_to(user_id, area_type, area_code, age_gp) ]
+                if not user_ids:
+                    continue
+            changed_centers = area.get_changed_centers()
+            if not changed_centers:
+                continue
+            summary_msg = area.summary_msg
+            if len(changed_centers) < len(area.centers):
+                summary_msg += '\nNew slots opened at {} of them'.format(len(changed_centers))
+            section_items, truncated = self.build_update_section(summary_msg, changed_centers)
+            digest.add_section(section_items, truncated, user_ids)
+            has_sections.update(user_ids)
+        # one message sequence per user, however many of their subscriptions had updates
+        num_queued = 0
+        for user_ids, msg_chunks in digest.build(self.get_digest_footer, constants.MAX_MESSAGE_LENGTH):
+            num_queued += self.outbox.enqueue([ (user_id,) + changed[user_id] for user_id in user_ids ], msg_chunks)
+        released.extend( (user_id, hold_id) for user_id, (hold_id, due) in changed.items() if user_id not in has_sections )
+        self.outbox.withdraw(released)
+        return num_queued
 
-    def push_updates(self):
+    def push_updates(self, poll_schedule = None, time_budget = SWEEP_SETTINGS['time_budget']):
+        # with a poll_schedule only the (area, age) items that are due get checked, and their results feed back into it.
+        # Items are fetched highest score first; with a time_budget, items not started before it runs out wait for the next sweep
         dist_to_age_to_user_ids, pincode_to_age_to_user_ids = self.data_handler.segregate_user_groups()
-        num_queries = len(dist_to_age_to_user_ids) + len(pincode_to_age_to_user_ids)
-        users_who_got_broadcast = []
+        area_to_age_wise_users = {}
         for area_to_agewise_users, is_pincode in [(dist_to_age_to_user_ids, False), (pincode_to_age_to_user_ids, True)]:
-            print("----")
-            area_type = 'pincode' if is_pincode else 'district'
             for area_code, age_wise_users in area_to_agewise_users.items():
-                age_groups = age_wise_users.keys()
-                data_gen = self.data_handler.get_filtered_data_for_location(age_groups, area_code, is_pincode, slot_threshold = 1)
-                print("Handle - %s" % area_code)
-                for age_gp, centers in data_gen:
-                    slot_count = self.get_slot_count(centers)
-                    if not slot_count['all']:
-                        continue
-
-                    area_rec = self.data_handler.get_area_update_record(area_type, area_code, age_gp)
-                    area_update_summary = self.get_area_update_summary(centers)
-
-                    if not self.is_to_send_update(area_rec, area_update_summary, centers):
-                        log_msg("update skipped for {} {} {}".format(area_type, area_code, age_gp))
-                        continue
-
-                    log_msg("area - {}, slot - {}, age - {}".format(area_code, slot_count, age_gp))
-                    # add check for slot count here .. 
-                    summary_msg = self.summarize(slot_count, len(centers), age_gp, area_code, is_pincode)
-                    
-                    msg_chunks = self.build_msg_in_chunks(summary_msg, centers)
-                    for user_id in age_wise_users[age_gp]:
-                        try:
-                            for chunk in msg_chunks:
-                                self.bot.send_message(user_id, chunk)
-                            users_who_got_broadcast.append(user_id)
-                        except Exception as ee:
-                            log_msg("Failed for user {} reason {}".format(user_id, str(ee)))
-
-                    self.data_handler.update_area_rec(area_rec, area_update_summary)
-
-        self.data_handler.update_broadcast_count_for_users(users_who_got_broadcast)
+                area_to_age_wise_users[(area_code, is_pincode)] = age_wise_users
+
+        area_to_age_groups = { area : list(age_wise_users.keys()) for area, age_wise_users in area_to_age_wise_users.items() }
+        if poll_schedule is not None:
+            poll_schedule.prune( (area_code, is_pincode, age_gp) for (area_code, is_pincode), age_groups in area_to_age_groups.items() for age_gp in age_groups )
+            area_to_age_groups = { (area_code, is_pincode) : [ age_gp for age_gp in age_groups if poll_schedule.is_due((area_code, is_pincode, age_gp)) ]
+                                        for (area_code, is_pincode), age_groups in area_to_age_groups.items() }
+            area_to_age_groups = { area : age_groups for area, age_groups in area_to_age_groups.items() if age_groups }
+            log_msg("{} areas due for polling".format(len(area_to_age_groups)))
+        area_to_age_groups = self.prioritize(area_to_age_groups, area_to_age_wise_users)
+        num_items = sum(len(age_groups) for age_groups in area_to_age_groups.values())
+        num_checked = 0
+        deadline = time.monotonic() + time_budget if time_budget else None
+        failed_areas = set()
+        data_gen = self.data_handler.get_filtered_data_for_locations(area_to_age_groups, slot_threshold = 1, max_workers = self.max_fetch_workers,
+                                                                        deadline = deadline, failed_areas = failed_areas)
+        sweep_start = time.monotonic()
+        num_coalesced = self.coalescer.stats.coalesced
+        for area_code, is_pincode, age_gp, centers in data_gen:
+            area_type = 'pincode' if is_pincode else 'district'
+            age_wise_users = area_to_age_wise_users[(area_code, is_pincode)]
+            self.sweep_planner.record_checked((area_code, is_pincode, age_gp))
+            num_checked += 1
+            if centers is None:
+                # payload unchanged since this area was last handled, nothing to filter, diff or render
+                if poll_schedule is not None:
+                    key = (area_code, is_pincode, age_gp)
+                    poll_schedule.record(key, poll_schedule.get_last_slot_count(key), len(age_wise_users[age_gp]))
+                METRICS.inc('broadcast_areas_total', decision='unchanged')
+                continue
+            slot_count = self.get_slot_count(centers)
+            if poll_schedule is not None:
+                poll_schedule.record((area_code, is_pincode, age_gp), slot_count['all'], len(age_wise_users[age_gp]))
+            area_rec = self.data_handler.get_area_update_record(area_type, area_code, age_gp)
+            prev_fingerprint = AreaFingerprint.decode(area_rec.last_fingerprint) or {}
+            if not slot_count['all']:
+                if prev_fingerprint:
+                    self.data_handler.update_area_fingerprint(area_rec, AreaFingerprint.encode({}))
+                self.coalescer.drop((area_code, is_pincode, age_gp))
+                METRICS.inc('broadcast_areas_total', decision='no_slots')
+                continue
+
+            fingerprint = AreaFingerprint.build(centers)
+            delta = AreaFingerprint.diff(prev_fingerprint, fingerprint)
+            self.data_handler.update_area_fingerprint(area_rec, AreaFingerprint.encode(fingerprint))
+            area_update_summary = self.get_area_update_summary(centers)
+
+            if not self.is_to_send_update(delta, centers):
+                log_msg("update skipped for {} {} {}".format(area_type, area_code, age_gp))
+                if (area_code, is_pincode, age_gp) in self.coalescer.pending_areas:
+                    self.coalescer.refresh((area_code, is_pincode, age_gp), self.summarize(slot_count, len(centers), age_gp, area_code, is_pincode), centers)
+                METRICS.inc('broadcast_areas_total', decision='skipped')
+                continue
+
+            log_msg("area - {}, slot - {}, age - {}, {}".format(area_code, slot_count, age_gp, delta))
+            summary_msg = self.summarize(slot_count, len(centers), age_gp, area_code, is_pincode)
+            self.coalescer.add((area_code, is_pincode, age_gp), summary_msg, centers, delta.changed_center_ids(), age_wise_users[age_gp])
+            METRICS.inc('broadcast_areas_total', decision='sent')
+
+            self.data_handler.update_area_rec(area_rec, area_update_summary)
+
+        for area_code, is_pincode in failed_areas:
+            for age_gp in area_to_age_groups[(area_code, is_pincode)]:
+                if poll_schedule is not None:
+                    poll_schedule.record_failure((area_code, is_pincode, age_gp))
+                METRICS.inc('broadcast_areas_total', decision='failed')
+        # items skipped by the deadline stay due, the sweep planner puts them first next time
+        num_queued = self.queue_pending()
+        # fingerprints, area records and the digests they produced, held ones included, are committed together
+        self.data_handler.save_pincode_index()
         self.data_handler.commit_db_session()
+        log_msg("{} digests queued".format(num_queued))
+
+        send_stats = self.deliver_queued()
+        log_msg("Broadcast done - {}".format(send_stats))
+        if self.coalescer.window:
+            log_msg("Coalescing - {} this sweep, {} users pending, total {}".format(self.coalescer.stats.coalesced - num_coalesced,
+                                                                                    self.coalescer.num_pending_users(), self.coalescer.stats))
+        num_failed = sum(len(area_to_age_groups[area]) for area in failed_areas)
+        if num_failed:
+            log_msg("{} of {} area/age items failed to fetch, backed off".format(num_failed, num_items))
+        if num_checked + num_failed < num_items:
+            log_msg("{} of {} area/age items deferred to the next sweep".format(num_items - num_checked - num_failed, num_items))
+        health = self.data_handler.get_api_health()
+        if health['state'] != 'closed' or health['stale_areas']:
+            log_msg("CoWIN API {}, {} areas served stale, rate {:.1f}/s".format(health['state'], health['stale_areas'], health['rate']))
+        METRICS.observe('broadcast_sweep_seconds', time.monotonic() - sweep_start)
+
+    def deliver_queued(self):
+        # sends whatever is due in the outbound queue, new digests and earlier ones waiting for a retry
+        sender = TelegramFanOut(self.bot, num_workers = self.num_send_workers, global_rate = SEND_SETTINGS['global_per_sec'],
+                                    global_burst = SEND_SETTINGS['global_per_sec'], is_fatal = is_fatal_send_error)
+        sender.start()
+        # the same instant for both, so a held message is never sent while the coalescer can still change it
+        now = time.time()
+        self.coalescer.pop_due(now)
+        for message_id, user_id, msg_chunks, next_chunk, attempts in self.outbox.get_due(now = datetime.fromtimestamp(now)):
+            sender.submit(user_id, msg_chunks[next_chunk:], tag = (message_id, next_chunk, attempts))
+        # mark progress as it happens, so a restart only resends what was in flight
+        while not sender.wait_idle(SEND_SETTINGS['record_interval']):
+            self.record_deliveries(sender)
+        send_stats = sender.join()
+        self.record_deliveries(sender)
+        if sender.aborted is not None:
+            log_msg("Outbound queue drain stopped, {}. Undelivered messages stay queued".format(sender.aborted))
+        self.outbox.purge()
+        return send_stats
+
+    def record_deliveries(self, sender):
+        unreachable = self.outbox.record(sender.pop_finished())
+        if unreachable:
+            log_msg("{} users unreachable, updates stopped for them".format(len(unreachable)))
+            self.data_handler.unsubscribe_users(unreachable)
+        self.data_handler.update_broadcast_count_for_users(sender.pop_delivered_chat_ids())
+
+
+    def run_daemon(self, tick_secs = DAEMON_SETTINGS['tick_secs']):
+        # keeps db connections, http pool and the response cache warm across polls
+        from apscheduler.schedulers.blocking import BlockingScheduler
+
+        poll_schedule = AdaptivePollSchedule()
+        self.coalescer.window = DAEMON_SETTINGS['coalesce_window']
+        scheduler = BlockingScheduler()
+        scheduler.add_job(self._daemon_tick, 'interval', seconds=tick_secs, args=[poll_schedule], 
+                            max_instances=1, coalesce=True, next_run_time=datetime.now())
+        log_msg("Broadcaster daemon started, tick every {}s".format(tick_secs))
+        try:
+            scheduler.start()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+
+    def _daemon_tick(self, poll_schedule):
+        health = self.data_handler.get_api_health()
+        if health['state'] == 'open' and health['retry_in'] > 0:
+            # nothing but stale payloads until the breaker lets a probe through, skip instead of piling on.
+            # Once the cooldown is over the sweep runs, its first request is the probe that moves the breaker on
+            log_msg("CoWIN API circuit open, skipping tick (retry in {:.0f}s)".format(health['retry_in']))
+            try:
+                self.deliver_queued()       # retries due from earlier sweeps don't depend on the CoWIN API
+            except Exception:
+                logging.exception("Outbound queue drain failed")
+                self.data_handler.rollback_db_session()
+            return
+        try:
+            self.push_updates(poll_schedule, DAEMON_SETTINGS['sweep_budget'])
+        except Exception:
+            logging.exception("Broadcast tick failed")
+            self.data_handler.rollback_db_session()
 
 
 if __name__ == '__main__':  
-    brd = BroadCaster()
-    brd.push_updates()
\ No newline at end of file
+    METRICS.start()
+    if '--daemon' in sys.argv:
+        brd = BroadCaster(response_cache_time=DAEMON_SETTINGS['response_cache_time'])
+        brd.run_daemon()
+    else:
+        brd = BroadCaster()
+        brd.push_updates()
+        METRICS.dump()      # a one-shot run ends before the periodic dump would fire
\ No newline at end of file
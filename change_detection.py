@@ -0,0 +1,66 @@
+import json
+import zlib
+
+
+DELTA_THRESHOLDS = {
+    'min_opened_capacity' : 2,      # a session that opened with fewer seats than this is ignored
+    'min_capacity_jump' : 10,       # an already open session must gain at least these many seats ..
+    'min_capacity_jump_ratio' : 0.5,    # .. and grow by this fraction to count as a change
+}
+
+
+class AreaDelta:
+    def __init__(self):
+        self.new_center_ids = set()
+        self.opened_sessions = {}       # center_id -> [session_id]
+        self.capacity_jumps = {}        # center_id -> [(session_id, old_capacity, new_capacity)]
+
+    def changed_center_ids(self):
+        return self.new_center_ids | set(self.opened_sessions) | set(self.capacity_jumps)
+
+    def __bool__(self):
+        return bool(self.new_center_ids or self.opened_sessions or self.capacity_jumps)
+
+    def __str__(self):
+        return 'new centres {}, opened sessions {}, capacity jumps {}'.format(len(self.new_center_ids),
+                    sum(len(ss) for ss in self.opened_sessions.values()), sum(len(ss) for ss in self.capacity_jumps.values()))
+
+
+class AreaFingerprint:
+    # center_id -> session_id -> available capacity, for the centers of one (area, age) with open slots
+
+    @staticmethod
+    def build(centers):
+        return { str(center.center_id_) : { ss.session_id_ : ss.available_capacity_ for ss in center.sessions_ } for center in centers }
+
+    @staticmethod
+    def encode(fingerprint):
+        return zlib.compress(json.dumps(fingerprint, separators=(',', ':')).encode())
+
+    @staticmethod
+    def decode(blob):
+        if not blob:
+            return None
+        try:
+            return json.loads(zlib.decompress(blob).decode())
+        except (zlib.error, ValueError):
+            return None
+
+    @staticmethod
+    def diff(prev, curr, thresholds = DELTA_THRESHOLDS):
+        delta = AreaDelta()
+        for center_id, sessions in curr.items():
+            prev_sessions = prev.get(center_id)
+            if prev_sessions is None:
+                if any(cap >= thresholds['min_opened_capacity'] for cap in sessions.values()):
+                    delta.new_center_ids.add(center_id)
+                continue
+            for session_id, capacity in sessions.items():
+                prev_capacity = prev_sessions.get(session_id)
+                if prev_capacity is None:
+                    if capacity >= thresholds['min_opened_capacity']:
+                        delta.opened_sessions.setdefault(center_id, []).append(session_id)
+                elif (capacity - prev_capacity >= thresholds['min_capacity_jump']) and \
+                        (capacity - prev_capacity >= prev_capacity * thresholds['min_capacity_jump_ratio']):
+                    delta.capacity_jumps.setdefault(center_id, []).append((session_id, prev_capacity, capacity))
+        return delta
@@ -0,0 +1,140 @@
+import time
+import uuid
+
+from metrics import METRICS
+
+
+class _PendingArea:
+    # newest state of one (area, age group) update waiting to be delivered
+    __slots__ = ('summary_msg', 'centers', 'changed_center_ids', 'user_ids')
+
+    def __init__(self, summary_msg, centers, changed_center_ids):
+        self.summary_msg = summary_msg
+        self.centers = centers
+        self.changed_center_ids = set(changed_center_ids)
+        self.user_ids = set()
+
+    def get_changed_centers(self):
+        # changed at any point while pending, as they are in the newest snapshot (centres that went away are dropped)
+        return [ center for center in self.centers if str(center.center_id_) in self.changed_center_ids ]
+
+
+class CoalesceStats:
+    def __init__(self):
+        self.added = 0          # per user notifications handed in
+        self.coalesced = 0      # of those, merged into a message already pending for the user
+        self.replaced = 0       # area updates that replaced an older pending snapshot of the same area
+        self.dropped = 0        # pending area updates dropped because the slots were gone before delivery
+
+    def __str__(self):
+        return 'notifications {}, coalesced {}, replaced snapshots {}, dropped {}'.format(self.added, self.coalesced, self.replaced, self.dropped)
+
+
+class NotificationCoalescer:
+    # Sits between the send decision and delivery. A user is sent at most one message per `window` secs:
+    # the first notification goes out right away, later ones wait until the window since the last delivery
+    # has passed. While waiting, a newer update for the same area replaces the pending one, so a busy slot
+    # drop becomes one message with the latest numbers instead of a burst, and an area whose slots are gone
+    # before delivery is dropped. window = 0 passes everything through.
+    # Only decides what each user's message holds and when it is due; the message itself is kept in the
+    # outbound queue (rewritten whenever it changes, see pop_changes), so a held message survives a restart.
+    def __init__(self, window = 0):
+        self.window = window
+        self.pending_areas = {}     # (area_code, is_pincode, age_gp) -> _PendingArea
+        self.user_to_keys = {}      # user_id -> set of pending area keys
+        self.user_to_due = {}       # user_id -> time its pending message may be sent
+        self.user_to_hold = {}      # user_id -> id of its pending message, one per window
+        self.last_flush = {}        # user_id -> time of its last delivery, only while within the window
+        self.changed_users = set()  # users whose pending message changed since the last pop_changes
+        self.released = []          # (user_id, hold id) of pending messages left with nothing to send
+        self.stats = CoalesceStats()
+
+    def add(self, key, summary_msg, centers, changed_center_ids, user_ids, now = None):
+        now = time.time() if now is None else now
+        area = self.pending_areas.get(key)
+        if area is None:
+            area = self.pending_areas[key] = _PendingArea(summary_msg, centers, changed_center_ids)
+        else:
+            area.summary_msg, area.centers = summary_msg, centers
+            area.changed_center_ids.update(changed_center_ids)
+            self.changed_users.update(area.user_ids)
+            self.stats.replaced += 1
+        for user_id in user_ids:
+            self.stats.added += 1
+            keys = self.user_to_keys.get(user_id)
+            if keys is None:
+                keys = self.user_to_keys[user_id] = set()
+                last_flush = self.last_flush.get(user_id)
+                self.user_to_due[user_id] = now if last_flush is None else max(now, last_flush + self.window)
+                self.user_to_hold[user_id] = uuid.uuid4().hex
+            else:
+                self.stats.coalesced += 1
+                METRICS.inc('broadcast_coalesced_total')
+            keys.add(key)
+            area.user_ids.add(user_id)
+            self.changed_users.add(user_id)
+
+    def refresh(self, key, summary_msg, centers):
+        # the area was checked again without a new send decision, a pending message carries the newest numbers
+        area = self.pending_areas.get(key)
+        if area is not None:
+            area.summary_msg, area.centers = summary_msg, centers
+            self.changed_users.update(area.user_ids)
+
+    def drop(self, key):
+        # the area has no slots left, its pending update is no longer worth sending
+        area = self.pending_areas.pop(key, None)
+        if area is None:
+            return
+        for user_id in area.user_ids:
+            keys = self.user_to_keys[user_id]
+            keys.discard(key)
+            if keys:
+                self.changed_users.add(user_id)
+                continue
+            del self.user_to_keys[user_id]
+            del self.user_to_due[user_id]
+            self.released.append((user_id, self.user_to_hold.pop(user_id)))
+            self.changed_users.discard(user_id)
+        self.stats.dropped += 1
+
+    def pop_changes(self):
+        # ({ area key : (_PendingArea, [user_ids]) }, { user_id : (hold id, due time) }, [(user_id, hold id)]) -
+        # the pending messages that changed, to be (re)written, and the ones that were released, to be withdrawn
+        key_to_users, changed = {}, {}
+        for user_id in self.changed_users:
+            changed[user_id] = (self.user_to_hold[user_id], self.user_to_due[user_id])
+            for key in self.user_to_keys[user_id]:
+                if key not in key_to_users:
+                    key_to_users[key] = (self.pending_areas[key], [])
+                key_to_users[key][1].append(user_id)
+        released = self.released
+        self.changed_users, self.released = set(), []
+        return key_to_users, changed, released
+
+    def pop_due(self, now = None):
+        # forgets the pending messages that are due at `now`, they are delivered from the outbound queue. Returns their user ids
+        now = time.time() if now is None else now
+        due_users = [ user_id for user_id, due in self.user_to_due.items() if due <= now ]
+        for user_id in due_users:
+            del self.user_to_due[user_id]
+            del self.user_to_hold[user_id]
+            self.changed_users.discard(user_id)
+            for key in self.user_to_keys.pop(user_id):
+                area = self.pending_areas[key]
+                area.user_ids.discard(user_id)
+                if not area.user_ids:
+                    del self.pending_areas[key]
+            self.last_flush[user_id] = now
+        self._prune(now)
+        return due_users
+
+    def _prune(self, now):
+        if not self.window:
+            self.last_flush.clear()
+            return
+        for user_id in [ user_id for user_id, flushed in self.last_flush.items() if flushed + self.window <= now ]:
+            del self.last_flush[user_id]
+
+    def num_pending_users(self):
+        return len(self.user_to_keys)
@@ -0,0 +1,48 @@
+import os
+import gzip
+
+
+FIXTURE_SETTINGS = {
+    'mode' : os.environ.get('COWIN_FIXTURE_MODE'),     # 'record' saves every fetched response, 'replay' serves them instead of the API
+    'dir' : os.environ.get('COWIN_FIXTURE_DIR', 'fetched_data/fixtures'),
+}
+
+
+class FixtureStore:
+    # gzipped calendarByDistrict / calendarByPin response bodies, one file per area. The date is left
+    # out of the name so recorded data can be replayed on any day.
+    def __init__(self, dir_name = FIXTURE_SETTINGS['dir']):
+        self.dir_name = dir_name
+
+    def path(self, area_code, is_pin_code_based):
+        return os.path.join(self.dir_name, '{}_{}.json.gz'.format('pincode' if is_pin_code_based else 'district', area_code))
+
+    def save(self, area_code, is_pin_code_based, body):
+        os.makedirs(self.dir_name, exist_ok=True)
+        file_name = self.path(area_code, is_pin_code_based)
+        tmp_file = file_name + '.tmp'
+        with open(tmp_file, 'wb') as fp:
+            fp.write(gzip.compress(body))
+        os.replace(tmp_file, file_name)
+
+    def load_compressed(self, area_code, is_pin_code_based):
+        try:
+            with open(self.path(area_code, is_pin_code_based), 'rb') as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def load(self, area_code, is_pin_code_based):
+        body = self.load_compressed(area_code, is_pin_code_based)
+        return gzip.decompress(body) if body is not None else None
+
+    def areas(self):
+        # [(area_code, is_pin_code_based)] of every recorded response
+        if not os.path.isdir(self.dir_name):
+            return []
+        areas = []
+        for file_name in sorted(os.listdir(self.dir_name)):
+            if file_name.endswith('.json.gz'):
+                area_type, area_code = file_name[:-len('.json.gz')].split('_', 1)
+                areas.append((area_code, area_type == 'pincode'))
+        return areas
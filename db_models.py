@@ -1,5 +1,5 @@
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, Integer, String, Boolean, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, LargeBinary, Text, UniqueConstraint
 from sqlalchemy import Sequence
 from sqlalchemy.sql import func
 
@@ -22,6 +22,7 @@ class User(Base):
     area_type = Column(String(10))
     area_code = Column(String(12))
     age_group = Column(Integer)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now(), index = True)   # watermark for SubscriptionIndex.refresh
     # signup_time = Column(DateTime, server_default=func.now())
 
     def __repr__(self):
@@ -29,6 +30,21 @@ class User(Base):
     def __str__(self):
         return self.__repr__()
 
+class Subscription(Base):
+    # areas a user follows on top of the one in `users`, delivered together with it as one digest per broadcast
+    __tablename__ = 'subscriptions'
+    __table_args__ = (UniqueConstraint('user_id', 'area_type', 'area_code', 'age_group'), )
+    subscription_id = Column(Integer, Sequence('subscription_id_seq'), primary_key = True)
+    user_id = Column(Integer, index = True, nullable = False)
+    area_type = Column(String(10))
+    area_code = Column(String(12))
+    age_group = Column(Integer)
+    is_active = Column(Boolean, default = True)     # rows are deactivated rather than deleted so SubscriptionIndex.refresh sees removals
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now(), index = True)
+
+    def __repr__(self):
+        return "Subscription - %s %s %s %s"%(self.user_id, self.area_type, self.area_code, self.age_group)
+
 class UserActivity(Base):
     __tablename__ = 'user_activity'
     user_id = Column(Integer, primary_key = True)
@@ -42,6 +58,21 @@ class AreaUpdate(Base):
     age_gp = Column(Integer, primary_key = True)
     last_update = Column(String(65), nullable = True)
     last_update_time = Column(DateTime, nullable = True)
+    last_fingerprint = Column(LargeBinary(length = 2**24 - 1), nullable = True)    # see change_detection.AreaFingerprint
+
+class OutboundMessage(Base):
+    # durable broadcast queue, one row per user digest, see outbound_queue.OutboundQueue
+    __tablename__ = 'outbound_messages'
+    message_id = Column(Integer, Sequence('outbound_message_id_seq'), primary_key = True)
+    message_key = Column(String(64), unique = True, nullable = False)   # idempotency key, a held digest is rewritten in place
+    user_id = Column(Integer, index = True, nullable = False)
+    chunks = Column(Text(length = 2**24 - 1))       # json list of message texts
+    next_chunk = Column(Integer, default = 0)       # chunks before this one were delivered
+    status = Column(String(10), default = 'pending', index = True)   # pending / sent / failed
+    attempts = Column(Integer, default = 0)
+    next_attempt_at = Column(DateTime, index = True)
+    last_error = Column(String(200), nullable = True)
+    created_at = Column(DateTime, server_default=func.now())
 
 
 def get_db_login_info():
@@ -0,0 +1,39 @@
+from collections import defaultdict
+
+from render import split_message
+
+
+class DigestBuilder:
+    # Collects the update sections each user is due during one sweep so every user gets a single message
+    # sequence, however many of their subscriptions had news. Users due the same set of sections share the
+    # rendered chunks, so rendering grows with the number of distinct combinations, not with users.
+    def __init__(self):
+        self.sections = []      # section id -> (items, truncated)
+        self.user_to_sections = defaultdict(list)
+
+    def add_section(self, items, truncated, user_ids):
+        section_id = len(self.sections)
+        self.sections.append((items, truncated))
+        for user_id in user_ids:
+            self.user_to_sections[user_id].append(section_id)
+        return section_id
+
+    def __len__(self):
+        return len(self.user_to_sections)
+
+    def build(self, get_footer, max_len):
+        # yields (user_ids, msg_chunks), get_footer(truncated) gives the closing items once per digest
+        combo_to_user_ids = defaultdict(list)
+        for user_id, section_ids in self.user_to_sections.items():
+            combo_to_user_ids[tuple(section_ids)].append(user_id)
+        for section_ids, user_ids in combo_to_user_ids.items():
+            items = []
+            truncated = False
+            for ind, section_id in enumerate(section_ids):
+                section_items, section_truncated = self.sections[section_id]
+                if ind:
+                    items.append('')
+                items += section_items
+                truncated = truncated or section_truncated
+            items += get_footer(truncated)
+            yield user_ids, split_message(items, max_len)
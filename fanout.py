@@ -0,0 +1,250 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram.error import RetryAfter
+
+from metrics import METRICS
+
+
+# Telegram allows ~30 msgs/sec overall and ~1 msg/sec to the same chat (short bursts are tolerated)
+TELEGRAM_LIMITS = {
+    'global_per_sec' : 30,
+    'global_burst' : 30,
+    'per_chat_per_sec' : 1,
+    'per_chat_burst' : 3,
+}
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        # takes a token and returns 0 if one is available, else returns the secs to wait for the next one
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.reserve()
+
+
+class _Job:
+    def __init__(self, chat_id, num_msgs, tag = None):
+        self.chat_id = chat_id
+        self.num_msgs = num_msgs
+        self.remaining = num_msgs
+        self.tag = tag
+
+
+class _Lane:
+    # messages queued for a single chat, sent in order
+    def __init__(self):
+        self.pending = deque()
+        self.scheduled = False
+        self.bucket = TokenBucket(TELEGRAM_LIMITS['per_chat_per_sec'], TELEGRAM_LIMITS['per_chat_burst'])
+
+
+class FanOutStats:
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.msgs_sent = 0
+        self.jobs_delivered = 0
+        self.jobs_failed = 0
+        self.flood_waits = 0
+        self.max_queue_depth = 0
+        self.queue_depth = 0
+
+    def elapsed(self):
+        return (self.end_time or time.monotonic()) - self.start_time
+
+    def msgs_per_sec(self):
+        elapsed = self.elapsed()
+        return self.msgs_sent / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return 'sent {} msgs in {:.1f}s ({:.1f} msgs/s), users - delivered {}, failed {}, flood waits {}, queue depth - max {}, now {}'.format(
+                self.msgs_sent, self.elapsed(), self.msgs_per_sec(), self.jobs_delivered, self.jobs_failed,
+                self.flood_waits, self.max_queue_depth, self.queue_depth)
+
+
+class TelegramFanOut:
+    # Sends messages through a pool of worker threads. Every chat gets its own lane so a
+    # RetryAfter (flood wait) for one chat only pauses that chat, while the global bucket
+    # keeps the overall rate within the bot limits.
+    def __init__(self, bot, num_workers = 8, global_rate = TELEGRAM_LIMITS['global_per_sec'], global_burst = TELEGRAM_LIMITS['global_burst'],
+                    is_fatal = None):
+        self.bot = bot
+        self.is_fatal = is_fatal    # is_fatal(exception) - True stops all sending, e.g. the bot token was revoked
+        self.aborted = None         # the fatal exception, once one was seen
+        self.num_workers = num_workers
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.lanes = {}
+        self.ready = []         # heap of (ready_time, seq, chat_id)
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.closed = False
+        self.workers = []
+        self.delivered_chat_ids = []
+        self.failed = []        # (chat_id, exception)
+        self.finished = []      # (tag, chat_id, msgs sent, exception or None) for jobs submitted with a tag
+        self.stats = FanOutStats()
+
+    def start(self):
+        self.stats = FanOutStats()
+        for ind in range(self.num_workers):
+            worker = threading.Thread(target=self._worker, name='fanout-%d'%ind, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, chat_id, msgs, tag = None):
+        if not msgs:
+            return
+        job = _Job(chat_id, len(msgs), tag)
+        with self.cond:
+            lane = self.lanes.get(chat_id)
+            if lane is None:
+                lane = self.lanes[chat_id] = _Lane()
+            lane.pending.extend((job, msg) for msg in msgs)
+            self.stats.queue_depth += len(msgs)
+            self.stats.max_queue_depth = max(self.stats.max_queue_depth, self.stats.queue_depth)
+            if not lane.scheduled:
+                self._schedule(chat_id, lane, time.monotonic())
+            self.cond.notify()
+
+    def pop_delivered_chat_ids(self):
+        with self.cond:
+            delivered, self.delivered_chat_ids = self.delivered_chat_ids, []
+        return delivered
+
+    def pop_finished(self):
+        with self.cond:
+            finished, self.finished = self.finished, []
+        return finished
+
+    def wait_idle(self, timeout):
+        # True once everything submitted so far was sent or given up
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while (self.stats.queue_depth and self.aborted is None) or self.in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def join(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.closed = False
+        self.stats.end_time = time.monotonic()
+        return self.stats
+
+    def _schedule(self, chat_id, lane, ready_time):
+        lane.scheduled = True
+        heapq.heappush(self.ready, (ready_time, next(self.seq), chat_id))
+
+    def _next_lane(self):
+        with self.cond:
+            while True:
+                if self.aborted is not None:
+                    return None, None
+                if self.ready:
+                    ready_time, _, chat_id = self.ready[0]
+                    now = time.monotonic()
+                    if ready_time <= now:
+                        heapq.heappop(self.ready)
+                        self.in_flight += 1
+                        return chat_id, self.lanes[chat_id]
+                    self.cond.wait(ready_time - now)
+                elif self.closed and self.in_flight == 0:
+                    return None, None
+                else:
+                    self.cond.wait()
+
+    def _worker(self):
+        while True:
+            chat_id, lane = self._next_lane()
+            if lane is None:
+                return
+            delay = lane.bucket.reserve()
+            if delay > 0:
+                self._release_lane(chat_id, lane, delay)
+                continue
+
+            self.global_bucket.acquire()
+            job, msg = lane.pending[0]
+            delay = 0
+            try:
+                with METRICS.timer('broadcast_send_seconds'):
+                    self.bot.send_message(chat_id, msg)
+                METRICS.inc('broadcast_messages_total', result='sent')
+                with self.cond:
+                    lane.pending.popleft()
+                    self.stats.msgs_sent += 1
+                    self.stats.queue_depth -= 1
+                    job.remaining -= 1
+                    if job.remaining == 0:
+                        self.stats.jobs_delivered += 1
+                        self.delivered_chat_ids.append(chat_id)
+                        if job.tag is not None:
+                            self.finished.append((job.tag, chat_id, job.num_msgs, None))
+            except RetryAfter as ee:
+                # keep the message at the head of the lane and pause only this chat
+                delay = ee.retry_after
+                METRICS.inc('broadcast_messages_total', result='flood_wait')
+                with self.cond:
+                    self.stats.flood_waits += 1
+            except Exception as ee:
+                if self.is_fatal is not None and self.is_fatal(ee):
+                    # the failure isn't about this chat, leave the job (and everything after it) unsent
+                    with self.cond:
+                        if self.aborted is None:
+                            logging.error("Sending stopped, {}".format(str(ee)))
+                            self.aborted = ee
+                            self.failed.append((chat_id, ee))
+                    self._release_lane(chat_id, lane, 0)
+                    continue
+                logging.error("Failed for user {} reason {}".format(chat_id, str(ee)))
+                METRICS.inc('broadcast_messages_total', result='failed')
+                with self.cond:
+                    while lane.pending and lane.pending[0][0] is job:
+                        lane.pending.popleft()
+                        self.stats.queue_depth -= 1
+                    self.stats.jobs_failed += 1
+                    self.failed.append((chat_id, ee))
+                    if job.tag is not None:
+                        self.finished.append((job.tag, chat_id, job.num_msgs - job.remaining, ee))
+            self._release_lane(chat_id, lane, delay)
+
+    def _release_lane(self, chat_id, lane, delay):
+        with self.cond:
+            self.in_flight -= 1
+            if lane.pending:
+                self._schedule(chat_id, lane, time.monotonic() + delay)
+            else:
+                lane.scheduled = False
+                del self.lanes[chat_id]
+            self.cond.notify_all()
@@ -1,26 +1,166 @@
 import json
+import hashlib
 import requests
 from urllib.parse import urlencode
 import operator
-from cachetools import cachedmethod, TTLCache
+from cachetools import cachedmethod, Cache, TTLCache, LRUCache
 from cachetools.keys import hashkey
 import time
 import os
+import random
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+from pincode_index import PincodeDistrictIndex
+from metrics import METRICS
+from cowin_fixtures import FixtureStore, FIXTURE_SETTINGS
+import json_decoder
 
 import logging
 logging.basicConfig(level=logging.INFO)
 
+
+class RateLimiter:
+    # spaces out calls so that at most `max_per_sec` of them start in any second, shared across threads
+    def __init__(self, max_per_sec):
+        self.interval = (1.0 / max_per_sec) if max_per_sec else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+THROTTLE_SETTINGS = {
+    'max_rate' : 50,                # requests/sec ceiling when the connector isn't given one
+    'min_rate' : 0.2,
+    'increase_step' : 0.5,          # requests/sec added back after every successful request
+    'decrease_factor' : 0.5,        # rate multiplier on a throttled / failed request
+    'failure_threshold' : 5,        # consecutive failures that open the breaker
+    'base_cooldown' : 15,           # secs the breaker stays open the first time, doubled on every reopen
+    'max_cooldown' : 600,
+    'catalogue_retry_base' : 60,    # secs before a failed states/districts refresh is tried again, doubled per failure
+    'catalogue_retry_max' : 3600,
+}
+
+THROTTLED_STATUS_CODES = {403, 429}
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    # AIMD: the rate creeps back up by a fixed step on success and is cut by a factor when throttled
+    def __init__(self, max_per_sec, settings = THROTTLE_SETTINGS):
+        self.max_rate = max_per_sec or settings['max_rate']
+        self.min_rate = settings['min_rate']
+        self.increase_step = settings['increase_step']
+        self.decrease_factor = settings['decrease_factor']
+        self.rate = self.max_rate
+        super().__init__(self.rate)
+
+    def _set_rate(self, rate):
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+        self.interval = 1.0 / self.rate
+
+    def on_success(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self._set_rate(self.rate + self.increase_step)
+
+    def on_throttled(self):
+        with self.lock:
+            self._set_rate(self.rate * self.decrease_factor)
+
+
+class CircuitBreaker:
+    # closed -> open after `failure_threshold` consecutive failures. While open every request is refused
+    # until a jittered, exponentially growing cooldown passes, then a single probe is let through (half_open):
+    # success closes the breaker, failure reopens it for longer.
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, settings = THROTTLE_SETTINGS):
+        self.failure_threshold = settings['failure_threshold']
+        self.base_cooldown = settings['base_cooldown']
+        self.max_cooldown = settings['max_cooldown']
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.num_opens = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and time.monotonic() >= self.open_until:
+                self._set_state(CircuitBreaker.HALF_OPEN)
+                return True
+            return False    # still cooling down, or the half open probe is in flight
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != CircuitBreaker.CLOSED:
+                self.num_opens = 0
+                self._set_state(CircuitBreaker.CLOSED)
+
+    def record_failure(self, retry_after = None):
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.num_opens += 1
+                cooldown = min(self.max_cooldown, self.base_cooldown * 2 ** (self.num_opens - 1))
+                cooldown = random.uniform(cooldown / 2, cooldown)     # jitter, so restarted workers don't probe in lockstep
+                self.open_until = time.monotonic() + max(cooldown, retry_after or 0)
+                self._set_state(CircuitBreaker.OPEN)
+
+    def _set_state(self, state):
+        if state != self.state:
+            logging.warning("CoWIN API circuit breaker {} -> {}".format(self.state, state))
+            METRICS.inc('cowin_breaker_transitions_total', state=state)
+        self.state = state
+
+    def retry_in(self):
+        with self.lock:
+            return max(0.0, self.open_until - time.monotonic()) if self.state == CircuitBreaker.OPEN else 0.0
+
+
+class InstrumentedTTLCache(TTLCache):
+    # counts entries dropped for space (evicted) or age (expired), hits and misses are counted in fetch_data
+    def popitem(self):
+        item = super().popitem()
+        METRICS.inc('cowin_response_cache_total', result='evicted')
+        return item
+
+    def expire(self, time = None):
+        # TTLCache.currsize itself expires entries, read the plain Cache size instead
+        size = Cache.currsize.fget(self)
+        result = super().expire(time)
+        expired = size - Cache.currsize.fget(self)
+        if expired:
+            METRICS.inc('cowin_response_cache_total', expired, result='expired')
+        return result
+
+
 class CowinDataConnector:
-    ROOT_URL = 'https://cdn-api.co-vin.in'
+    ROOT_URL = os.environ.get('COWIN_API_ROOT', 'https://cdn-api.co-vin.in')     # point at a local stand-in for load tests
     PIN_URL = ROOT_URL + '/api/v2/appointment/sessions/public/calendarByPin' #?pincode=%d&date=02-05-2021
     DIST_URL = ROOT_URL + '/api/v2/appointment/sessions/public/calendarByDistrict' #?district_id=114&date=07-05-2021'
     STATE_LIST_URL = ROOT_URL + '/api/v2/admin/location/states'
     DISTRICT_LIST_URL = ROOT_URL + '/api/v2/admin/location/districts/'
     STATES_FILE_NAME = 'fetched_data/states.json'
+    SKIPPED = object()     # a fetch not started before the sweep deadline
 
     HEADERS = {
-        'Host' : 'cdn-api.co-vin.in',
+        'Host' : urlparse(ROOT_URL).netloc,
         'User-Agent' : 'Mozilla/5.0 (X11; Linux x86_64; rv:86.0) Gecko/20100101 Firefox/86.0',
         'Accept' : 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
         'Accept-Language' : 'en-US,en;q=0.5',
@@ -37,11 +177,33 @@ class CowinDataConnector:
     ONE_DAY = 60*60*24
     QUATER_DAY = ONE_DAY / 4
 
-    def __init__(self, response_cache_time = 120, max_cache_records = 1024):
-        self.cache = TTLCache(maxsize=max_cache_records, ttl=response_cache_time)
-        self.cache_state_data = TTLCache(maxsize=2, ttl=CowinDataConnector.ONE_DAY)
+    def __init__(self, response_cache_time = 120, max_cache_records = 1024, pool_size = 10, max_requests_per_sec = None, shared_cache = None,
+                    fixture_mode = FIXTURE_SETTINGS['mode'], fixture_dir = FIXTURE_SETTINGS['dir']):
+        self.response_cache_time = response_cache_time
+        self.cache = InstrumentedTTLCache(maxsize=max_cache_records, ttl=response_cache_time)
+        self.shared_cache = shared_cache     # optional SqliteResponseStore, consulted when the in-process cache misses
+        self.cache_lock = threading.RLock()
+        # outlives the TTL cache: (etag, last_modified, body_hash, data) of the last 200 response per area
+        self.validators = LRUCache(maxsize=max_cache_records)
+        self.states_data = None
+        self.states_data_time = 0
+        self.states_lock = threading.Lock()
+        self.states_refreshing = False
+        self.states_failures = 0
+        self.states_retry_at = 0        # no refresh attempt before this, after a failed one
         self.session = requests.session()
         self.session.headers.update(CowinDataConnector.HEADERS)
+        # keep-alive connections are reused across worker threads, size the pool to match them
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.rate_limiter = AdaptiveRateLimiter(max_requests_per_sec)
+        self.breaker = CircuitBreaker()
+        self.stale_keys = set()     # areas currently answered with the last good payload because the API is failing
+        self.pincode_index = PincodeDistrictIndex()
+        self.states_data_from_disk = None
+        self.fixture_mode = fixture_mode
+        self.fixtures = FixtureStore(fixture_dir) if fixture_mode else None
 
     def _build_url(self, url, **kwargs):
         return url + '?' + urlencode(kwargs)
@@ -51,73 +213,254 @@ class CowinDataConnector:
     #     return CowinDataConnector.PIN_URL + '?' + urlencode(query_data)
 
 
-    @cachedmethod(operator.attrgetter('cache'))
+    @cachedmethod(operator.attrgetter('cache'), lock=operator.attrgetter('cache_lock'))
     def _fetch_data_helper(self, area_code, date_str, is_pin_code_based):
         if is_pin_code_based:
             url = self._build_url(CowinDataConnector.PIN_URL, pincode=area_code, date=date_str)
         else:
             url = self._build_url(CowinDataConnector.DIST_URL, district_id=area_code, date=date_str)
 
-        response = self.session.get(url)
-        logging.info('GET: {}'.format(url))
+        key = (area_code, date_str, is_pin_code_based)
+        with self.cache_lock:
+            prev = self.validators.get(key)
+
+        shared_key, shared_body = None, None
+        if self.shared_cache is not None:
+            shared_key = self.shared_cache.make_key(area_code, date_str, is_pin_code_based)
+            entry = self.shared_cache.get(shared_key)
+            if entry is not None:
+                shared_body, etag, last_modified, body_hash, fetched_at = entry
+                if prev is None or prev[2] != body_hash:
+                    prev = (etag, last_modified, body_hash, None)
+                if time.time() - fetched_at <= self.response_cache_time:
+                    # another process fetched it recently enough for us
+                    METRICS.inc('cowin_response_cache_total', result='shared_hit')
+                    return self._remember_response(key, prev, shared_body)
+
+        if self.fixture_mode == 'replay':
+            return self._replay_response(key, prev, area_code, is_pin_code_based)
+
+        headers = {}
+        if prev is not None:
+            etag, last_modified, _, _ = prev
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        if not self.breaker.allow_request():
+            return self._serve_stale(key, prev, shared_body)
+
+        self.rate_limiter.wait()
+        endpoint = 'pincode' if is_pin_code_based else 'district'
+        try:
+            with METRICS.timer('cowin_request_seconds', endpoint=endpoint):
+                response = self.session.get(url, headers=headers)
+        except requests.RequestException as ee:
+            logging.error("API request failed {}. {}".format(url, ee))
+            self._record_failure()
+            return self._serve_stale(key, prev, shared_body)
+        METRICS.inc('cowin_responses_total', endpoint=endpoint, status=response.status_code)
+        logging.info('GET: {} {}'.format(url, response.status_code))
+        if response.status_code in THROTTLED_STATUS_CODES or response.status_code >= 500:
+            logging.error("API request throttled/failed {} {}".format(url, response.status_code))
+            self._record_failure(response.headers.get('Retry-After'))
+            return self._serve_stale(key, prev, shared_body)
+        self.breaker.record_success()
+        self.rate_limiter.on_success()
+        if response.status_code == 304 and prev is not None:
+            if shared_key is not None:
+                self.shared_cache.touch(shared_key)
+            return self._remember_response(key, prev, shared_body)
         if response.status_code != 200:
             logging.error("API request failed {}. Resp - {}".format(url, response.text))
             return None
-        try:
-            data = json.loads(response.text)
-        except:
-            data = {}
+
+        body_hash = hashlib.blake2b(response.content, digest_size=16).hexdigest()
+        data = prev[3] if (prev is not None and prev[2] == body_hash) else None
+        prev = (response.headers.get('ETag'), response.headers.get('Last-Modified'), body_hash, data)
+        if shared_key is not None:
+            self.shared_cache.put(shared_key, response.content, prev[0], prev[1], body_hash)
+        if self.fixture_mode == 'record':
+            self.fixtures.save(area_code, is_pin_code_based, response.content)
+        return self._remember_response(key, prev, response.content)
+
+    def _replay_response(self, key, prev, area_code, is_pin_code_based):
+        body = self.fixtures.load(area_code, is_pin_code_based)
+        if body is None:
+            logging.error("No recorded response for {} {}".format('pincode' if is_pin_code_based else 'district', area_code))
+            return None
+        body_hash = hashlib.blake2b(body, digest_size=16).hexdigest()
+        data = prev[3] if (prev is not None and prev[2] == body_hash) else None
+        return self._remember_response(key, (None, None, body_hash, data), body)
+
+    def _remember_response(self, key, validators, body, stale = False):
+        # reuses the already parsed object when the body hash matches the one we have seen before
+        etag, last_modified, body_hash, data = validators
+        if data is None:
+            try:
+                data = json_decoder.decode_calendar(body)
+            except:
+                data = {}
+        with self.cache_lock:
+            self.validators[key] = (etag, last_modified, body_hash, data)
+            if stale:
+                self.stale_keys.add(key)
+            else:
+                self.stale_keys.discard(key)
         return data
 
+    def _record_failure(self, retry_after = None):
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None      # http-date form, the breaker's own cooldown applies
+        self.rate_limiter.on_throttled()
+        self.breaker.record_failure(retry_after)
+
+    def _serve_stale(self, key, prev, shared_body):
+        # last good payload for the area, if we have one. It is cached like a fresh one so callers
+        # don't retry the failing API before the TTL runs out.
+        if prev is None or (prev[3] is None and shared_body is None):
+            return None
+        METRICS.inc('cowin_response_cache_total', result='stale')
+        return self._remember_response(key, prev, shared_body, stale=True)
+
+    def is_stale(self, area_code, date, is_pin_code_based = False):
+        with self.cache_lock:
+            return (str(area_code), date.strftime("%d-%m-%Y"), is_pin_code_based) in self.stale_keys
+
+    def get_health(self):
+        # for callers that want to slow down or reorder work while the API is pushing back
+        return {
+            'state' : self.breaker.state,
+            'retry_in' : self.breaker.retry_in(),
+            'consecutive_failures' : self.breaker.failures,
+            'rate' : self.rate_limiter.rate,
+            'stale_areas' : len(self.stale_keys),
+        }
+
+
+    def _catalogue_get(self, url):
+        # states/districts requests go through the same rate limiter and breaker as the calendar ones
+        if not self.breaker.allow_request():
+            raise Exception("CoWIN API circuit open, {} not requested".format(url))
+        self.rate_limiter.wait()
+        try:
+            response = self.session.get(url)
+        except requests.RequestException:
+            self._record_failure()
+            raise
+        if response.status_code in THROTTLED_STATUS_CODES or response.status_code >= 500:
+            self._record_failure(response.headers.get('Retry-After'))
+        else:
+            self.breaker.record_success()
+            self.rate_limiter.on_success()
+        return response
+
+    def _fetch_district_list(self, state_id):
+        response = self._catalogue_get(CowinDataConnector.DISTRICT_LIST_URL + str(state_id))
+        if response.status_code != 200:
+            raise Exception("District list request failed for state {} - {}".format(state_id, response.status_code))
+        return json_decoder.loads(response.content)
+
 
-    def _fetch_states_and_districts_and_dump(self):
-        logging.info("-- fetch_states_and_districts_and_dump()")
-        response = self.session.get(CowinDataConnector.STATE_LIST_URL)
+    def _fetch_states_and_districts(self, max_workers = 8):
+        logging.info("-- fetch_states_and_districts()")
+        response = self._catalogue_get(CowinDataConnector.STATE_LIST_URL)
         if response.status_code != 200:
             return None
-        states_data = json.loads(response.text)
+        states_data = json_decoder.loads(response.content)
+        state_ids = [ state['state_id'] for state in states_data['states'] ]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            district_lists = list(executor.map(self._fetch_district_list, state_ids))
+
         state_name_to_id = {}
         state_to_district_names = defaultdict(list)
+        state_to_districts = defaultdict(list)     # district names are only unique within a state
         district_name_to_id = {}
-        for state in states_data['states']:
+        for state, district_data in zip(states_data['states'], district_lists):
             state_id = state['state_id']
             state_name_to_id[state['state_name']] = state_id
-
-            response2 = self.session.get(CowinDataConnector.DISTRICT_LIST_URL + str(state['state_id']))
-            if response2.status_code != 200:
-                return None
-
-            district_data = json.loads(response2.text)
             for district in district_data['districts']:
                 district_name, district_id = district['district_name'], district['district_id']
                 district_name_to_id[district_name] = district_id
                 state_to_district_names[state_id].append(district_name)
-            
-        with open(CowinDataConnector.STATES_FILE_NAME, 'w') as fp:
-            data = {
-                'state_name_to_id': state_name_to_id, 
-                'state_to_district_names': state_to_district_names, 
-                'district_name_to_id' : district_name_to_id,
-                'district_id_to_name' : { val:key for key, val in district_name_to_id.items() }
-            }
-            #print(data)
+                state_to_districts[state_id].append([district_id, district_name])
+
+        return {
+            'state_name_to_id': state_name_to_id, 
+            'state_to_district_names': dict(state_to_district_names), 
+            'state_to_districts': dict(state_to_districts), 
+            'district_name_to_id' : district_name_to_id,
+            'district_id_to_name' : { val:key for key, val in district_name_to_id.items() }
+        }
+
+
+    @staticmethod
+    def _normalize_states_data(data):
+        # json turns the int ids used as keys into strings, bring them back so lookups by id work on disk data too
+        data = dict(data)
+        data['state_to_district_names'] = { int(key) : val for key, val in data['state_to_district_names'].items() }
+        data['district_id_to_name'] = { int(key) : val for key, val in data['district_id_to_name'].items() }
+        if 'state_to_districts' in data:
+            data['state_to_districts'] = { int(key) : val for key, val in data['state_to_districts'].items() }
+        return data
+
+
+    def _dump_states_data(self, data):
+        tmp_file = CowinDataConnector.STATES_FILE_NAME + '.tmp'
+        with open(tmp_file, 'w') as fp:
             json.dump(data, fp)
-            return data
+        os.replace(tmp_file, CowinDataConnector.STATES_FILE_NAME)
+
+
+    def _refresh_states_data(self):
+        try:
+            data = self._fetch_states_and_districts()
+            if data is not None:
+                data = CowinDataConnector._normalize_states_data(data)
+                if data != self.states_data:
+                    self._dump_states_data(data)
+                    logging.info("states/districts catalogue changed, written to disk")
+                elif os.path.exists(CowinDataConnector.STATES_FILE_NAME):
+                    os.utime(CowinDataConnector.STATES_FILE_NAME)  # mark as checked so a restart doesn't refetch
+                self.states_data = data
+                self.states_data_time = time.time()
+                self.states_failures = 0
+                return
+            logging.error("states/districts refresh failed, state list unavailable")
+        except Exception as ee:
+            logging.error("states/districts refresh failed. {}".format(ee))
+        finally:
+            self.states_refreshing = False
+        # keep serving the old copy, and don't try again on every call
+        self.states_failures += 1
+        delay = min(THROTTLE_SETTINGS['catalogue_retry_max'], THROTTLE_SETTINGS['catalogue_retry_base'] * 2 ** (self.states_failures - 1))
+        self.states_retry_at = time.time() + random.uniform(delay / 2, delay)
 
 
-    @cachedmethod(operator.attrgetter('cache_state_data'))
     def get_states_data(self):
-        logging.info("-- get_states_data()")
-        try: 
-            data = self. _fetch_states_and_districts_and_dump()
-        except:
-            data = None
+        # stale-while-revalidate: always answers from memory, an expired copy is refreshed in the background
+        if self.states_data is None:
+            with self.states_lock:
+                if self.states_data is None:
+                    data = self.fetch_states_and_districts_from_disk()
+                    if data is not None:
+                        self.states_data = CowinDataConnector._normalize_states_data(data)
+                        self.states_data_time = os.path.getmtime(CowinDataConnector.STATES_FILE_NAME)
+                    else:
+                        if time.time() >= self.states_retry_at:
+                            self._refresh_states_data()     # nothing to serve yet, has to be fetched inline
+                        return self.states_data
 
-        if data is None:
-            # try from disk
-            with open(CowinDataConnector.STATES_FILE_NAME, 'r') as fp:
-                data = json.load(fp)
-        return data 
+        if (time.time() - self.states_data_time) > CowinDataConnector.ONE_DAY and time.time() >= self.states_retry_at:
+            with self.states_lock:
+                if self.states_refreshing:
+                    return self.states_data
+                self.states_refreshing = True
+            threading.Thread(target=self._refresh_states_data, name='states-refresh', daemon=True).start()
+        return self.states_data
 
         
     def fetch_states_and_districts_from_disk(self):
@@ -135,21 +478,59 @@ class CowinDataConnector:
             pin_code_to_centers[str(center['pincode'])].append(center)
         new_cache_entries = [((pin_code, date_str, True), {'centers': centers}) for pin_code, centers in
                              pin_code_to_centers.items()]
-        self.cache.update(new_cache_entries)
+        with self.cache_lock:
+            self.cache.update(new_cache_entries)
         return
 
+    def get_data_version(self, area_code, date, is_pin_code_based = False):
+        # hash of the response body behind the data fetch_data currently returns, same hash means unchanged payload
+        with self.cache_lock:
+            prev = self.validators.get((str(area_code), date.strftime("%d-%m-%Y"), is_pin_code_based))
+        return prev[2] if prev is not None else None
+
     def fetch_data(self, area_code, date, is_pin_code_based = False):
         date_str = date.strftime("%d-%m-%Y")
         area_code = str(area_code)
+        if METRICS.enabled:
+            with self.cache_lock:
+                cached = hashkey(area_code, date_str, is_pin_code_based) in self.cache
+            METRICS.inc('cowin_response_cache_total', result='hit' if cached else 'miss')
         data = self._fetch_data_helper(area_code, date_str, is_pin_code_based)
         if data is None:
-            self.cache.pop(hashkey(area_code, date_str, is_pin_code_based), None)
+            with self.cache_lock:
+                self.cache.pop(hashkey(area_code, date_str, is_pin_code_based), None)
             logging.error("API returned empty data. {}".format(area_code))
         else:
             if not is_pin_code_based: # area type is district
                 self._update_pin_code_cache_with_district_data(data, date_str)
+                self.pincode_index.learn_from_district_data(area_code, data)
+            else:
+                if self.states_data_from_disk is None:
+                    self.states_data_from_disk = self.fetch_states_and_districts_from_disk() or {}
+                self.pincode_index.learn_from_pincode_data(data, self.states_data_from_disk)
 
         return data
 
+    def _fetch_data_before(self, deadline, area_code, date, is_pin_code_based):
+        if deadline is not None and time.monotonic() > deadline:
+            return CowinDataConnector.SKIPPED
+        return self.fetch_data(area_code, date, is_pin_code_based)
 
-
+    def fetch_data_for_areas(self, areas, date, max_workers = 8, deadline = None):
+        # areas - iterable of (area_code, is_pin_code_based), fetches start in the given order and results are
+        # yielded in completion order as (area_code, is_pin_code_based, data, data_version).
+        # Areas whose fetch hasn't started by `deadline` (time.monotonic()) are skipped and not yielded, a failed fetch yields no data.
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = { executor.submit(self._fetch_data_before, deadline, area_code, date, is_pin_code_based) : (area_code, is_pin_code_based)
+                            for area_code, is_pin_code_based in areas }
+            for future in as_completed(futures):
+                area_code, is_pin_code_based = futures[future]
+                try:
+                    data = future.result()
+                except Exception as ee:
+                    logging.error("Fetch failed for {}. {}".format(area_code, ee))
+                    data = None
+                if data is CowinDataConnector.SKIPPED:
+                    continue
+                version = self.get_data_version(area_code, date, is_pin_code_based) if data else None
+                yield area_code, is_pin_code_based, data, version
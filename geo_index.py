@@ -0,0 +1,85 @@
+from bisect import bisect_left
+
+from telegram import ReplyKeyboardMarkup
+
+
+def build_kb_layout(keys, cols = 3):
+    keys = sorted(keys)
+    return [ keys[ind: min(len(keys), ind + cols)] for ind in range(0, len(keys), cols) ]
+
+
+class PrefixIndex:
+    # sorted (lowercased key, value) pairs, a prefix lookup is a bisect plus a short scan
+    def __init__(self, entries):
+        self.entries = sorted( (key.lower(), value) for key, value in entries )
+        self.keys = [ key for key, _ in self.entries ]
+
+    def search(self, prefix, limit = 10):
+        prefix = prefix.lower()
+        matches = []
+        ind = bisect_left(self.keys, prefix)
+        while ind < len(self.keys) and self.keys[ind].startswith(prefix):
+            value = self.entries[ind][1]
+            if value not in matches:
+                matches.append(value)
+                if len(matches) >= limit:
+                    break
+            ind += 1
+        return matches
+
+
+class GeoIndex:
+    # Built once per states.json version: prebuilt keyboards, per-state district lookups and
+    # prefix search over district names and known pincodes.
+    def __init__(self, states_data, pincodes = ()):
+        self.states_data = states_data
+        self.state_name_to_id = states_data['state_name_to_id']
+        self.states_keyboard = ReplyKeyboardMarkup(build_kb_layout(self.state_name_to_id.keys()), one_time_keyboard=True)
+
+        self.state_to_district_name_to_id = {}
+        self.state_prefix_indexes = {}
+        district_entries = []
+        for state_id, districts in self._districts_per_state(states_data).items():
+            name_to_id = { name : district_id for district_id, name in districts }
+            self.state_to_district_name_to_id[state_id] = name_to_id
+            state_entries = []
+            for name, district_id in name_to_id.items():
+                value = (state_id, district_id, name)
+                state_entries.append((name, value))
+                # also match on later words, e.g. 'urban' finds 'Bangalore Urban'
+                for word in name.split()[1:]:
+                    state_entries.append((word, value))
+            self.state_prefix_indexes[state_id] = PrefixIndex(state_entries)
+            district_entries += state_entries
+        self.district_prefix_index = PrefixIndex(district_entries)
+
+        self.state_keyboards = { state_id : ReplyKeyboardMarkup(build_kb_layout(name_to_id.keys()), one_time_keyboard=True)
+                                    for state_id, name_to_id in self.state_to_district_name_to_id.items() }
+        self.num_pincodes = len(pincodes)
+        self.pincode_prefix_index = PrefixIndex( (str(pincode), str(pincode)) for pincode in pincodes )
+
+    @staticmethod
+    def _districts_per_state(states_data):
+        if 'state_to_districts' in states_data:
+            return states_data['state_to_districts']
+        # older states.json without per-state ids, names that repeat across states resolve to the same id
+        district_name_to_id = states_data['district_name_to_id']
+        return { state_id : [ (district_name_to_id[name], name) for name in names if name in district_name_to_id ]
+                    for state_id, names in states_data['state_to_district_names'].items() }
+
+    def get_state_id(self, state_name):
+        return self.state_name_to_id.get(state_name)
+
+    def get_state_keyboard(self, state_id):
+        return self.state_keyboards.get(state_id)
+
+    def get_district_id(self, state_id, district_name):
+        return self.state_to_district_name_to_id.get(state_id, {}).get(district_name)
+
+    def search_districts(self, prefix, state_id = None, limit = 10):
+        # returns [(state_id, district_id, district_name)]
+        index = self.district_prefix_index if state_id is None else self.state_prefix_indexes.get(state_id)
+        return index.search(prefix, limit) if index else []
+
+    def search_pincodes(self, prefix, limit = 10):
+        return self.pincode_prefix_index.search(prefix, limit)
@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS
+
+
+LANE_SETTINGS = {
+    'fast' : 4,         # workers for cheap handlers (db flag updates, ...)
+    'slow' : 8,         # workers for handlers that wait on the CoWIN API
+}
+
+
+class _WaitStats:
+    __slots__ = ('count', 'total_wait', 'max_wait')
+
+    def __init__(self):
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class HandlerLanes:
+    # Separate bounded worker pools, so a burst of slow handlers can't delay cheap ones queued
+    # behind them. Records how long every handler waited in its lane before it started running.
+    def __init__(self, settings = LANE_SETTINGS):
+        self.pools = { name : ThreadPoolExecutor(max_workers=workers, thread_name_prefix='lane-' + name) for name, workers in settings.items() }
+        self.pending = defaultdict(int)
+        self.wait_stats = defaultdict(_WaitStats)
+        self.lock = threading.Lock()
+
+    def submit(self, lane, handler_name, func, *args, **kwargs):
+        enqueued_at = time.monotonic()
+        with self.lock:
+            self.pending[lane] += 1
+        return self.pools[lane].submit(self._run, lane, handler_name, enqueued_at, func, *args, **kwargs)
+
+    def _run(self, lane, handler_name, enqueued_at, func, *args, **kwargs):
+        wait = time.monotonic() - enqueued_at
+        with self.lock:
+            self.pending[lane] -= 1
+            stats = self.wait_stats[handler_name]
+            stats.count += 1
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+        METRICS.observe('bot_lane_wait_seconds', wait, lane=lane)
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            logging.exception("Handler {} failed".format(handler_name))
+
+    def get_wait_stats(self):
+        # handler name -> (calls, avg wait secs, max wait secs)
+        with self.lock:
+            return { name : (stats.count, stats.total_wait / stats.count if stats.count else 0.0, stats.max_wait) for name, stats in self.wait_stats.items() }
+
+    def get_queue_depths(self):
+        with self.lock:
+            return dict(self.pending)
+
+    def report(self):
+        depths = ', '.join('{} {}'.format(lane, depth) for lane, depth in sorted(self.get_queue_depths().items()))
+        logging.info("Lane queue depth - {}".format(depths or 'idle'))
+        for name, (count, avg_wait, max_wait) in sorted(self.get_wait_stats().items()):
+            logging.info("Lane wait {} - calls {}, avg {:.3f}s, max {:.3f}s".format(name, count, avg_wait, max_wait))
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
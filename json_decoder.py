@@ -0,0 +1,64 @@
+import os
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+DECODER_SETTINGS = {
+    'backend' : os.environ.get('COWIN_JSON_BACKEND', 'orjson' if orjson is not None else 'json'),
+    # keep only the fields the bot reads, ~1/3 less held in the response caches for a slower decode
+    'selective' : os.environ.get('COWIN_JSON_SELECTIVE', '0') == '1',
+}
+
+# everything parse_data, the pin code cache and the pincode index (pincode, state_name + district_name) read from a calendar response
+CENTER_FIELDS = ('center_id', 'name', 'block_name', 'fee_type', 'pincode', 'state_name', 'district_name')
+SESSION_FIELDS = ('session_id', 'date', 'vaccine', 'available_capacity', 'available_capacity_dose1',
+                  'available_capacity_dose2', 'min_age_limit')
+
+
+def _json_loads(body):
+    return json.loads(body)
+
+
+def _orjson_loads(body):
+    return orjson.loads(body)
+
+
+BACKENDS = { 'json' : _json_loads }
+if orjson is not None:
+    BACKENDS['orjson'] = _orjson_loads
+
+
+def get_loads(backend = None):
+    backend = backend or DECODER_SETTINGS['backend']
+    if backend not in BACKENDS:
+        raise ValueError("JSON backend {} is not available, choices are {}".format(backend, ', '.join(BACKENDS)))
+    return BACKENDS[backend]
+
+
+def loads(body, backend = None):
+    # body - raw response bytes, both backends decode them without going through a str first
+    return get_loads(backend)(body)
+
+
+def extract_calendar(data):
+    # a calendarByDistrict / calendarByPin payload cut down to CENTER_FIELDS / SESSION_FIELDS, drops the
+    # addresses, coordinates, slot lists, ... that would otherwise stay in the response caches
+    centers = []
+    for center in data.get('centers', []):
+        slim = { field : center[field] for field in CENTER_FIELDS if field in center }
+        slim['sessions'] = [ { field : session[field] for field in SESSION_FIELDS if field in session }
+                                for session in center.get('sessions', []) ]
+        centers.append(slim)
+    return { 'centers' : centers }
+
+
+def decode_calendar(body, selective = None, backend = None):
+    data = loads(body, backend)
+    selective = DECODER_SETTINGS['selective'] if selective is None else selective
+    if selective and isinstance(data, dict) and 'centers' in data:
+        return extract_calendar(data)
+    return data
@@ -0,0 +1,174 @@
+import os
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+METRICS_SETTINGS = {
+    'port' : os.environ.get('COWIN_METRICS_PORT'),          # serves prometheus text on http://<host>:<port>/metrics
+    'dump_file' : os.environ.get('COWIN_METRICS_FILE'),     # or writes the same text to this file periodically
+    'dump_interval' : 60,
+}
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_NULL_TIMER = nullcontext()
+
+
+class _Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self, num_buckets):
+        self.counts = [0] * (num_buckets + 1)   # last one is +Inf
+        self.total = 0.0
+        self.count = 0
+
+
+class _Timer:
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry._observe(self.name, self.labels, time.perf_counter() - self.start)
+        return False
+
+
+class MetricsRegistry:
+    # Counters and latency histograms keyed by (name, labels). Nothing is recorded until enable() is
+    # called, a disabled registry costs a single attribute check per call.
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.enabled = False
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.dump_file = None
+
+    def enable(self):
+        self.enabled = True
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((key, str(val)) for key, val in labels.items()))
+
+    def inc(self, name, value = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, self._labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        self._observe(name, self._labels(labels), value)
+
+    def _observe(self, name, labels, value):
+        key = (name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = _Histogram(len(self.buckets))
+            hist.counts[bisect_left(self.buckets, value)] += 1
+            hist.total += value
+            hist.count += 1
+
+    def timer(self, name, **labels):
+        # with METRICS.timer('cowin_parse_seconds'): ...
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, self._labels(labels))
+
+    @staticmethod
+    def _format_labels(labels, extra = ()):
+        labels = labels + extra
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, val.replace('"', '\\"')) for key, val in labels) + '}'
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(hist.counts), hist.total, hist.count) for key, hist in self.histograms.items())
+
+        lines = []
+        prev_name = None
+        for (name, labels), value in counters:
+            if name != prev_name:
+                lines.append('# TYPE {} counter'.format(name))
+                prev_name = name
+            lines.append('{}{} {}'.format(name, self._format_labels(labels), value))
+        for (name, labels), counts, total, count in histograms:
+            if name != prev_name:
+                lines.append('# TYPE {} histogram'.format(name))
+                prev_name = name
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(name, self._format_labels(labels, (('le', str(bound)),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, self._format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, self._format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, file_name = None):
+        file_name = file_name or self.dump_file
+        if not (self.enabled and file_name):
+            return
+        tmp_file = file_name + '.tmp'
+        with open(tmp_file, 'w') as fp:
+            fp.write(self.render())
+        os.replace(tmp_file, file_name)
+
+    def _dump_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.dump()
+            except OSError as ee:
+                logging.error("Metrics dump to {} failed. {}".format(self.dump_file, ee))
+
+    def serve(self, port, host = '0.0.0.0'):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        return server
+
+    def start(self, settings = METRICS_SETTINGS):
+        # enables the registry only when an endpoint or a dump file is configured
+        if settings.get('port'):
+            self.enable()
+            self.serve(int(settings['port']))
+            logging.info("Metrics served on port {}".format(settings['port']))
+        if settings.get('dump_file'):
+            self.enable()
+            self.dump_file = settings['dump_file']
+            threading.Thread(target=self._dump_loop, args=(settings['dump_interval'],), name='metrics-dump', daemon=True).start()
+            logging.info("Metrics dumped to {} every {}s".format(self.dump_file, settings['dump_interval']))
+        return self.enabled
+
+
+METRICS = MetricsRegistry()
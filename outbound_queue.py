@@ -0,0 +1,176 @@
+import hashlib
+import json
+import math
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, func, and_, case
+from sqlalchemy.dialects import mysql, sqlite
+from telegram.error import Unauthorized, BadRequest, ChatMigrated
+
+from db_models import OutboundMessage, User
+from metrics import METRICS
+
+
+OUTBOX_SETTINGS = {
+    'batch_size' : 20000,       # due rows handed to the sender per drain
+    'max_attempts' : 6,         # transient failures before a message is given up
+    'retry_base' : 30,          # secs, doubled per attempt, with jitter
+    'retry_max' : 30 * 60,
+    'retention' : 6 * 60 * 60,  # secs sent / failed rows are kept around for inspection
+}
+
+
+# 403 descriptions that are about one chat. PTB raises Unauthorized for every 401/403, a revoked token included
+UNREACHABLE_ERRORS = ('bot was blocked by the user', 'user is deactivated', 'bot was kicked', 'chat not found')
+
+
+def classify_send_error(error):
+    # 'unreachable' - the user blocked the bot or the chat is gone, 'permanent' - this message will never go through,
+    # 'fatal' - nothing can be sent (bad token), 'transient' - worth another try later
+    description = str(error).lower()
+    if isinstance(error, Unauthorized):
+        return 'unreachable' if any(text in description for text in UNREACHABLE_ERRORS) else 'fatal'
+    if isinstance(error, BadRequest):
+        return 'unreachable' if 'chat not found' in description else 'permanent'
+    if isinstance(error, ChatMigrated):
+        return 'permanent'
+    return 'transient'
+
+
+def is_fatal_send_error(error):
+    return classify_send_error(error) == 'fatal'
+
+
+class OutboundQueue:
+    # Broadcast digests are written here in the same transaction as the AreaUpdate changes that produced them,
+    # then delivered from the table. A crash mid-sweep either loses both (the next sweep finds the same changes
+    # again) or neither (the next drain sends what is left). Delivery is at least once: a message sent right
+    # before a crash, but not yet marked, goes out again.
+    # A digest held back by the NotificationCoalescer is queued with next_attempt_at at the end of the user's
+    # window, and rewritten in place while it is held.
+    def __init__(self, db_session, engine):
+        self.db_session = db_session
+        self.dialect = engine.dialect.name
+        OutboundMessage.__table__.create(engine, checkfirst=True)
+
+    @staticmethod
+    def make_key(hold_id, user_id):
+        # one row per pending message of a user (see NotificationCoalescer), the same text in a later one is a new message
+        return hashlib.sha1('{}:{}'.format(hold_id, user_id).encode()).hexdigest()
+
+    def enqueue(self, user_holds, msg_chunks, chunk_size = 1000):
+        # user_holds - [(user_id, hold id, due time)]. A message already queued under the same hold is replaced, unless
+        # a send was attempted. Not committed here, see above. Returns the number of rows written
+        body = json.dumps(msg_chunks)
+        # whole secs, so a row is never due before the coalescer lets go of the message
+        rows = [ {'message_key' : OutboundQueue.make_key(hold_id, user_id), 'user_id' : user_id, 'chunks' : body, 'next_chunk' : 0,
+                    'status' : 'pending', 'attempts' : 0, 'next_attempt_at' : datetime.fromtimestamp(math.ceil(due))}
+                    for user_id, hold_id, due in user_holds ]
+        table = OutboundMessage.__table__
+        is_unsent = and_(table.c.status == 'pending', table.c.attempts == 0)
+        for ind in range(0, len(rows), chunk_size):
+            chunk = rows[ind: ind + chunk_size]
+            if self.dialect == 'mysql':
+                stmt = mysql.insert(table).values(chunk)
+                self.db_session.execute(stmt.on_duplicate_key_update(chunks = case((is_unsent, stmt.inserted.chunks), else_ = table.c.chunks)))
+            elif self.dialect == 'sqlite':
+                stmt = sqlite.insert(table).values(chunk)
+                self.db_session.execute(stmt.on_conflict_do_update(index_elements = ['message_key'], set_ = {'chunks' : stmt.excluded.chunks},
+                                                                    where = is_unsent))
+            else:
+                self._enqueue_per_row(chunk)
+        METRICS.inc('outbound_enqueued_total', len(rows))
+        return len(rows)
+
+    def _enqueue_per_row(self, rows):
+        keys = [ row['message_key'] for row in rows ]
+        existing = set(self.db_session.execute(select(OutboundMessage.message_key).where(OutboundMessage.message_key.in_(keys))).scalars())
+        for row in rows:
+            if row['message_key'] not in existing:
+                self.db_session.add(OutboundMessage(**row))
+            else:
+                self.db_session.execute(update(OutboundMessage).where(OutboundMessage.message_key == row['message_key'])
+                                            .where(OutboundMessage.status == 'pending').where(OutboundMessage.attempts == 0)
+                                            .values(chunks = row['chunks']).execution_options(synchronize_session = False))
+
+    def withdraw(self, user_holds, chunk_size = 1000):
+        # user_holds - [(user_id, hold id)] of held messages that no longer have anything to send. Not committed here
+        keys = [ OutboundQueue.make_key(hold_id, user_id) for user_id, hold_id in user_holds ]
+        for ind in range(0, len(keys), chunk_size):
+            self.db_session.execute(delete(OutboundMessage)
+                                        .where(OutboundMessage.message_key.in_(keys[ind: ind + chunk_size]))
+                                        .where(OutboundMessage.status == 'pending')
+                                        .where(OutboundMessage.attempts == 0)
+                                        .execution_options(synchronize_session = False))
+        return len(keys)
+
+    def get_due(self, now = None, limit = OUTBOX_SETTINGS['batch_size']):
+        # [(message_id, user_id, chunks, next_chunk, attempts)] oldest first. Messages of users who stopped updates are dropped
+        now = datetime.now() if now is None else now
+        self.db_session.execute(update(OutboundMessage)
+                                    .where(OutboundMessage.status == 'pending')
+                                    .where(OutboundMessage.user_id.in_(select(User.user_id).where(User.is_subscribed == False)))
+                                    .values(status = 'failed', last_error = 'unsubscribed')
+                                    .execution_options(synchronize_session = False))
+        rows = self.db_session.execute(select(OutboundMessage.message_id, OutboundMessage.user_id, OutboundMessage.chunks,
+                                                OutboundMessage.next_chunk, OutboundMessage.attempts)
+                                        .where(OutboundMessage.status == 'pending')
+                                        .where(OutboundMessage.next_attempt_at <= now)
+                                        .order_by(OutboundMessage.message_id)
+                                        .limit(limit)).all()
+        self.db_session.commit()
+        return [ (message_id, user_id, json.loads(chunks), next_chunk, attempts) for message_id, user_id, chunks, next_chunk, attempts in rows ]
+
+    def get_retry_delay(self, attempts):
+        delay = min(OUTBOX_SETTINGS['retry_max'], OUTBOX_SETTINGS['retry_base'] * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def record(self, finished):
+        # finished - (tag, user_id, msgs sent, exception or None) from TelegramFanOut, tag = (message_id, next_chunk, attempts).
+        # Returns the user ids found unreachable
+        sent_ids, unreachable = [], set()
+        now = datetime.now()
+        for (message_id, next_chunk, attempts), user_id, num_sent, error in finished:
+            if error is None:
+                sent_ids.append(message_id)
+                continue
+            kind = classify_send_error(error)
+            METRICS.inc('outbound_failures_total', kind=kind)
+            if kind == 'fatal':
+                continue    # stays pending as it was, the drain was stopped
+            values = {'next_chunk' : next_chunk + num_sent, 'attempts' : attempts + 1, 'last_error' : str(error)[:200]}
+            if kind == 'transient' and attempts + 1 < OUTBOX_SETTINGS['max_attempts']:
+                values['next_attempt_at'] = now + timedelta(seconds = self.get_retry_delay(attempts + 1))
+            else:
+                values['status'] = 'failed'
+                if kind == 'unreachable':
+                    unreachable.add(user_id)
+            self.db_session.execute(update(OutboundMessage).where(OutboundMessage.message_id == message_id).values(**values)
+                                        .execution_options(synchronize_session = False))
+        for ind in range(0, len(sent_ids), 1000):
+            self.db_session.execute(update(OutboundMessage).where(OutboundMessage.message_id.in_(sent_ids[ind: ind + 1000]))
+                                        .values(status = 'sent').execution_options(synchronize_session = False))
+        if unreachable:
+            # nothing else queued for them can be delivered either
+            self.db_session.execute(update(OutboundMessage)
+                                        .where(OutboundMessage.status == 'pending')
+                                        .where(OutboundMessage.user_id.in_(unreachable))
+                                        .values(status = 'failed', last_error = 'unreachable')
+                                        .execution_options(synchronize_session = False))
+        self.db_session.commit()
+        METRICS.inc('outbound_sent_total', len(sent_ids))
+        return unreachable
+
+    def purge(self):
+        cutoff = datetime.now() - timedelta(seconds = OUTBOX_SETTINGS['retention'])
+        result = self.db_session.execute(delete(OutboundMessage)
+                                            .where(OutboundMessage.status != 'pending')
+                                            .where(OutboundMessage.created_at < cutoff)
+                                            .execution_options(synchronize_session = False))
+        self.db_session.commit()
+        return result.rowcount
+
+    def get_counts(self):
+        rows = self.db_session.execute(select(OutboundMessage.status, func.count()).group_by(OutboundMessage.status))
+        return dict(rows.all())
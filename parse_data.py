@@ -1,10 +1,21 @@
 from collections import defaultdict
 from datetime import datetime
-from emojis import EMOJIS
+from functools import lru_cache
+import sys
+from metrics import METRICS
+from render import FRAGMENTS, render_sessions
+
+
+@lru_cache(maxsize=256)
+def parse_date(date_str):
+    # sessions only span a few days, so the same handful of date strings repeat across every center
+    return datetime.strptime(date_str, "%d-%m-%Y")
 
 
 class CowinCenterSession:
     ALL_AGE = 200
+    __slots__ = ('session_id_', 'date_', 'vaccine_', 'available_capacity_', 'available_capacity_dose1_', 
+                 'available_capacity_dose2_', 'min_age_limit_')
 
     def __init__(self, session_id, date, vaccine, available_capacity, available_capacity_dose1, available_capacity_dose2, min_age_limit):
         self.session_id_ = session_id
@@ -23,12 +34,12 @@ class CowinCenterSession:
         for session_d in data:
             kwargs = {
                 'session_id' : session_d['session_id'],
-                'date' : datetime.strptime(session_d['date'], "%d-%m-%Y"),
+                'date' : parse_date(session_d['date']),
                 'available_capacity' : int(session_d['available_capacity']),
                 'available_capacity_dose1' : int(session_d['available_capacity_dose1']),   
                 'available_capacity_dose2' : int(session_d['available_capacity_dose2']),      
                 'min_age_limit' : int(session_d['min_age_limit']),
-                'vaccine' : session_d['vaccine'],
+                'vaccine' : sys.intern(session_d['vaccine']),
             }
             yield CowinCenterSession(**kwargs)
         return
@@ -45,34 +56,26 @@ class CowinCenterSession:
 
     @staticmethod
     def get_session_msg(v_ss):
-        vaccine_to_sessions = defaultdict(list)
-        for session in v_ss:
-            vaccine_to_sessions[session.vaccine_].append(session)
-        msg = ''
-        for vaccine, v_ss in vaccine_to_sessions.items():
-            msg += '\nVaccine: {}'.format(vaccine.title())
-            msg += '''
-________________________________
-| Date |     Age     |       Seats 
-'''
-            for session in v_ss:
-                #vacc_name = session.vaccine_.title()[:min(10, len(session.vaccine_))]
-                dte = session.date_.strftime("%d/%m")
-                d1_cap = 'D1:{:3}'.format(session.available_capacity_dose1_ if session.available_capacity_dose1_ <= 999 else '1K+')
-                d2_cap = 'D2:{:3}'.format(session.available_capacity_dose2_ if session.available_capacity_dose2_ <= 999 else '1K+')
-                cap = '{}  {}'.format(d1_cap, d2_cap)
-                msg += ' {0} {1: >8}        {2: >12}\n'.format(dte, session.min_age_limit_, cap)
-            msg += '________________________________'
-        return msg
+        return render_sessions(v_ss)
 
 
 class CowinCenter:
-    def __init__(self, center_id, name, block_name, fee_type, sessions):
+    __slots__ = ('center_id_', 'name_', 'block_name_', 'fee_type_', 'pincode_', 'sessions_', 
+                 'available_capacity_', 'available_capacity_dose1_', 'available_capacity_dose2_')
+
+    def __init__(self, center_id, name, block_name, fee_type, sessions, pincode = None):
         self.center_id_ = center_id
         self.name_ = name
         self.block_name_ = block_name
         self.fee_type_ = fee_type
+        self.pincode_ = pincode
         self.sessions_ = sessions
+        self.available_capacity_ = sum(ss.available_capacity_ for ss in sessions)
+        self.available_capacity_dose1_ = sum(ss.available_capacity_dose1_ for ss in sessions)
+        self.available_capacity_dose2_ = sum(ss.available_capacity_dose2_ for ss in sessions)
+
+    def with_sessions(self, sessions):
+        return CowinCenter(self.center_id_, self.name_, self.block_name_, self.fee_type_, sessions, self.pincode_)
 
     
     @staticmethod
@@ -85,8 +88,9 @@ class CowinCenter:
             kwargs = {
                 'center_id' : center_d['center_id'],
                 'name' : center_d['name'],
-                'block_name' : block_name,   
-                'fee_type' : center_d['fee_type'],
+                'block_name' : sys.intern(block_name),   
+                'fee_type' : sys.intern(center_d['fee_type']),
+                'pincode' : str(center_d.get('pincode', '')),
                 'sessions' : list(CowinCenterSession.build_session_from_json(center_d['sessions'])),
             }
             yield CowinCenter(**kwargs)
@@ -105,16 +109,54 @@ class CowinCenter:
                 kwargs = {
                     'center_id' : center_d['center_id'],
                     'name' : center_d['name'],
-                    'block_name' : block_name,   
-                    'fee_type' : center_d['fee_type'],
+                    'block_name' : sys.intern(block_name),   
+                    'fee_type' : sys.intern(center_d['fee_type']),
+                    'pincode' : str(center_d.get('pincode', '')),
                     'sessions' : sessions,
                 }
                 yield CowinCenter(**kwargs)
 
 
     def __str__(self):
-        ss = EMOJIS['hospital']  + ' {}, {}\n'.format(self.name_, self.block_name_)
-        ss += 'Fee: {}'.format(self.fee_type_)
-        ss += CowinCenterSession.get_session_msg(self.sessions_)
-        ss += '\n\n'
-        return ss
+        return FRAGMENTS.render(self)
+
+
+class AreaSnapshot:
+    # Parsed form of one API response. Centers and sessions are built once and indexed by
+    # min_age_limit, so every age group / capacity filter is answered without re-parsing the json.
+    def __init__(self, centers):
+        self.centers_ = centers
+        self.age_index_ = defaultdict(list)     # min_age_limit -> [(center, sessions)]
+        for center in centers:
+            age_to_sessions = defaultdict(list)
+            for session in center.sessions_:
+                age_to_sessions[session.min_age_limit_].append(session)
+            for age, sessions in age_to_sessions.items():
+                self.age_index_[age].append((center, sessions))
+        self.filtered_cache_ = {}
+
+    @staticmethod
+    def build_from_json(json_data):
+        with METRICS.timer('cowin_parse_seconds'):
+            snapshot = AreaSnapshot(list(CowinCenter.build_from_json(json_data)))
+        METRICS.inc('cowin_parsed_centers_total', len(snapshot.centers_))
+        return snapshot
+
+    def for_pincode(self, pincode):
+        pincode = str(pincode)
+        return AreaSnapshot([center for center in self.centers_ if center.pincode_ == pincode])
+
+    def get_filtered_centers(self, filter_age, filter_capacity):
+        key = (filter_age, filter_capacity)
+        if key not in self.filtered_cache_:
+            if filter_age == CowinCenterSession.ALL_AGE:
+                candidates = ((center, center.sessions_) for center in self.centers_)
+            else:
+                candidates = self.age_index_.get(filter_age, [])
+            centers = []
+            for center, sessions in candidates:
+                sessions = [ss for ss in sessions if ss.available_capacity_ >= filter_capacity]
+                if sessions:
+                    centers.append(center.with_sessions(sessions))
+            self.filtered_cache_[key] = centers
+        return self.filtered_cache_[key]
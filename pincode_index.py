@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+import logging
+from collections import Counter
+
+
+class PincodeDistrictIndex:
+    # pincode -> district ids, learned from the centers seen in calendarByDistrict / calendarByPin responses.
+    # A pincode can have centres in more than one district, it is answered from all of them together
+    FILE_NAME = 'fetched_data/pincode_to_district.json'
+
+    def __init__(self, file_name = FILE_NAME):
+        self.file_name = file_name
+        self.pincode_to_districts = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.district_resolver = None   # (states_data it was built from, resolver)
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.file_name):
+            return
+        try:
+            with open(self.file_name) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError) as ee:
+            logging.error("Couldn't load pincode index {}. {}".format(self.file_name, ee))
+            return
+        with self.lock:
+            for pincode, district_ids in data.items():
+                # older files hold a single id per pincode
+                district_ids = district_ids if isinstance(district_ids, list) else [district_ids]
+                self.pincode_to_districts.setdefault(str(pincode), set()).update(int(district_id) for district_id in district_ids)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = { pincode : sorted(district_ids) for pincode, district_ids in self.pincode_to_districts.items() }
+            self.dirty = False
+        tmp_file = self.file_name + '.tmp'
+        with open(tmp_file, 'w') as fp:
+            json.dump(data, fp)
+        os.replace(tmp_file, self.file_name)
+
+    def get_pincodes(self):
+        with self.lock:
+            return list(self.pincode_to_districts.keys())
+
+    def get_districts(self, pincode):
+        # sorted district ids, empty when the pincode hasn't been seen yet
+        with self.lock:
+            return sorted(self.pincode_to_districts.get(str(pincode), ()))
+
+    def _add(self, pincode, district_id):
+        pincode, district_id = str(pincode), int(district_id)
+        district_ids = self.pincode_to_districts.setdefault(pincode, set())
+        if district_id not in district_ids:
+            district_ids.add(district_id)
+            self.dirty = True
+
+    def learn_from_district_data(self, district_id, data):
+        with self.lock:
+            for center in data.get('centers', []):
+                self._add(center['pincode'], district_id)
+
+    def learn_from_pincode_data(self, data, states_data):
+        # pincode responses only carry district and state names, map them back to ids using states.json
+        if not states_data:
+            return
+        if self.district_resolver is None or self.district_resolver[0] is not states_data:
+            self.district_resolver = (states_data, PincodeDistrictIndex.build_district_resolver(states_data))
+        state_district_to_id = self.district_resolver[1]
+        with self.lock:
+            for center in data.get('centers', []):
+                district_id = state_district_to_id.get((center.get('state_name'), center.get('district_name')))
+                if district_id is not None:
+                    self._add(center['pincode'], district_id)
+
+    @staticmethod
+    def build_district_resolver(states_data):
+        # (state_name, district_name) -> district_id. District names repeat across states (Hamirpur, Bilaspur, Pratapgarh),
+        # names that still can't be told apart are left out so their pincodes are never mapped to the wrong district
+        state_id_to_name = { str(state_id) : state_name for state_name, state_id in states_data['state_name_to_id'].items() }
+        resolver = {}
+        ambiguous = set()
+        if 'state_to_districts' in states_data:
+            for state_id, districts in states_data['state_to_districts'].items():
+                state_name = state_id_to_name.get(str(state_id))
+                for district_id, district_name in districts:
+                    key = (state_name, district_name)
+                    if resolver.get(key, district_id) != district_id:
+                        ambiguous.add(key)
+                    resolver[key] = district_id
+        else:
+            # older states.json, the flat name -> id map only holds one of the districts sharing a name
+            name_counts = Counter( name for names in states_data['state_to_district_names'].values() for name in set(names) )
+            district_name_to_id = states_data['district_name_to_id']
+            for state_id, names in states_data['state_to_district_names'].items():
+                state_name = state_id_to_name.get(str(state_id))
+                for name in names:
+                    if name_counts[name] > 1:
+                        ambiguous.add((state_name, name))
+                    elif name in district_name_to_id:
+                        resolver[(state_name, name)] = district_name_to_id[name]
+        for key in ambiguous:
+            resolver.pop(key, None)
+        return resolver
@@ -0,0 +1,117 @@
+import math
+import time
+
+
+POLL_SETTINGS = {
+    'min_interval' : 60,            # secs, for areas where slots keep showing up
+    'base_interval' : 300,          # secs, for areas seen for the first time
+    'max_interval' : 1800,          # secs, for areas that have had nothing for long
+    'speed_up' : 0.5,               # interval multiplier when slots are found
+    'back_off' : 1.5,               # interval multiplier when nothing is found
+}
+
+
+class _PollState:
+    __slots__ = ('interval', 'next_due', 'last_slots_time', 'last_slot_count')
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_due = 0
+        self.last_slots_time = None
+        self.last_slot_count = 0
+
+
+class AdaptivePollSchedule:
+    # Tracks, per (area_code, is_pincode, age_group), when the item should be polled next.
+    # Intervals shrink while slots keep appearing and grow while the area stays dead; areas
+    # with more subscribers are polled proportionally more often.
+    def __init__(self, settings = POLL_SETTINGS):
+        self.settings = settings
+        self.states = {}
+
+    def _clamp(self, interval):
+        return min(self.settings['max_interval'], max(self.settings['min_interval'], interval))
+
+    def is_due(self, key, now = None):
+        state = self.states.get(key)
+        now = time.time() if now is None else now
+        return (state is None) or (state.next_due <= now)
+
+    def record(self, key, slot_count, num_subscribers, now = None):
+        now = time.time() if now is None else now
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = _PollState(self.settings['base_interval'])
+        state.last_slot_count = slot_count
+        if slot_count:
+            state.interval = self._clamp(state.interval * self.settings['speed_up'])
+            state.last_slots_time = now
+        else:
+            state.interval = self._clamp(state.interval * self.settings['back_off'])
+        # 1 subscriber -> x1, 100 -> x2, 10k -> x3 more frequent
+        weight = 1 + math.log10(max(1, num_subscribers)) / 2
+        state.next_due = now + self._clamp(state.interval / weight)
+
+    def record_failure(self, key, now = None):
+        # the poll got no data, try again later the way a dead area would be. What it last had stays as it was
+        now = time.time() if now is None else now
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = _PollState(self.settings['base_interval'])
+        state.interval = self._clamp(state.interval * self.settings['back_off'])
+        state.next_due = now + state.interval
+
+    def prune(self, active_keys):
+        for key in set(self.states) - set(active_keys):
+            del self.states[key]
+
+    def get_last_slot_count(self, key):
+        # for a poll whose payload didn't change, it still has what it had
+        state = self.states.get(key)
+        return state.last_slot_count if state else 0
+
+    def get_interval(self, key):
+        state = self.states.get(key)
+        return state.interval if state else None
+
+
+SWEEP_SETTINGS = {
+    'subscriber_weight' : 1.0,      # per decade of subscribers, 10 -> 1, 10k -> 4
+    'activity_weight' : 2.0,        # for an area that had new slots just now, decays with activity_half_life
+    'activity_half_life' : 6 * 3600,
+    'staleness_weight' : 1.5,       # for an item not checked for staleness_horizon secs (or never)
+    'staleness_horizon' : 1800,
+    'time_budget' : None,           # secs a one-shot sweep may take before the remaining items are deferred
+}
+
+
+class SweepPlanner:
+    # Orders the (area_code, is_pincode, age_group) items of a sweep so the ones whose update matters to
+    # the most people are fetched first: many subscribers, slots opening there recently, not checked for long.
+    def __init__(self, settings = SWEEP_SETTINGS):
+        self.settings = settings
+        self.last_checked = {}
+
+    def score(self, key, num_subscribers, last_activity_time = None, now = None):
+        now = time.time() if now is None else now
+        settings = self.settings
+        score = settings['subscriber_weight'] * math.log10(1 + num_subscribers)
+        if last_activity_time is not None:
+            age = max(0, now - last_activity_time)
+            score += settings['activity_weight'] * 0.5 ** (age / settings['activity_half_life'])
+        last_checked = self.last_checked.get(key)
+        since_check = settings['staleness_horizon'] if last_checked is None else now - last_checked
+        score += settings['staleness_weight'] * min(1.0, since_check / settings['staleness_horizon'])
+        return score
+
+    def order(self, items, now = None):
+        # items - { key : (num_subscribers, last_activity_time) }, returns the keys highest score first
+        now = time.time() if now is None else now
+        return sorted(items, key = lambda key: -self.score(key, items[key][0], items[key][1], now))
+
+    def record_checked(self, key, now = None):
+        self.last_checked[key] = time.time() if now is None else now
+
+    def prune(self, active_keys):
+        for key in set(self.last_checked) - set(active_keys):
+            del self.last_checked[key]
@@ -0,0 +1,108 @@
+import threading
+from collections import defaultdict
+from functools import lru_cache
+
+from cachetools import LRUCache
+
+from emojis import EMOJIS
+from metrics import METRICS
+
+
+RENDER_SETTINGS = {
+    'fragment_cache_size' : 20000,      # rendered centres kept, keyed by their content version
+    'max_message_length' : 4096,        # telegram.constants.MAX_MESSAGE_LENGTH
+}
+
+SESSION_TABLE_HEADER = '''
+________________________________
+| Date |     Age     |       Seats 
+'''
+SESSION_TABLE_FOOTER = '________________________________'
+
+
+def _format_capacity(capacity):
+    return capacity if capacity <= 999 else '1K+'
+
+
+@lru_cache(maxsize=8192)
+def render_session_line(date, min_age_limit, dose1, dose2):
+    # the same (date, age, capacity) rows repeat across centres and polls
+    cap = 'D1:{:3}  D2:{:3}'.format(_format_capacity(dose1), _format_capacity(dose2))
+    return ' {0} {1: >8}        {2: >12}\n'.format(date.strftime("%d/%m"), min_age_limit, cap)
+
+
+def render_sessions(sessions):
+    vaccine_to_sessions = defaultdict(list)
+    for session in sessions:
+        vaccine_to_sessions[session.vaccine_].append(session)
+    parts = []
+    for vaccine, v_sessions in vaccine_to_sessions.items():
+        parts.append('\nVaccine: {}'.format(vaccine.title()))
+        parts.append(SESSION_TABLE_HEADER)
+        for session in v_sessions:
+            parts.append(render_session_line(session.date_, session.min_age_limit_, session.available_capacity_dose1_, session.available_capacity_dose2_))
+        parts.append(SESSION_TABLE_FOOTER)
+    return ''.join(parts)
+
+
+class FragmentCache:
+    # rendered text per centre, keyed by everything the text depends on. A centre that didn't change
+    # between polls (or shows up again for another age group with the same sessions) is rendered once.
+    def __init__(self, maxsize = RENDER_SETTINGS['fragment_cache_size']):
+        self.fragments = LRUCache(maxsize=maxsize)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def content_version(center):
+        return (center.center_id_, center.name_, center.block_name_, center.fee_type_,
+                tuple((ss.vaccine_, ss.date_, ss.min_age_limit_, ss.available_capacity_dose1_, ss.available_capacity_dose2_) for ss in center.sessions_))
+
+    def render(self, center):
+        key = FragmentCache.content_version(center)
+        with self.lock:
+            fragment = self.fragments.get(key)
+        if fragment is not None:
+            METRICS.inc('render_fragment_cache_total', result='hit')
+            return fragment
+        METRICS.inc('render_fragment_cache_total', result='miss')
+        fragment = ''.join([EMOJIS['hospital'], ' {}, {}\n'.format(center.name_, center.block_name_),
+                            'Fee: {}'.format(center.fee_type_), render_sessions(center.sessions_), '\n\n'])
+        with self.lock:
+            self.fragments[key] = fragment
+        return fragment
+
+
+FRAGMENTS = FragmentCache()
+
+
+def _split_long(text, max_len):
+    # pieces of at most max_len, cut at the last line break that fits when there is one
+    start = 0
+    while len(text) - start > max_len:
+        cut = text.rfind('\n', start, start + max_len + 1)
+        if cut == -1:
+            yield text[start:start + max_len]
+            start += max_len
+        else:
+            if cut > start:
+                yield text[start:cut]
+            start = cut + 1
+    yield text[start:]
+
+
+def split_message(items, max_len = RENDER_SETTINGS['max_message_length']):
+    # items (str or anything with a __str__) joined by line breaks into as few messages of at most max_len as
+    # possible without splitting an item, unless the item alone is longer than max_len. Linear in the total length.
+    chunks = []
+    parts, size = [], 0
+    for item in items:
+        text = item if isinstance(item, str) else str(item)
+        for piece in _split_long(text, max_len):
+            if parts and size + 1 + len(piece) > max_len:
+                chunks.append('\n'.join(parts))
+                parts, size = [], 0
+            size += len(piece) + (1 if parts else 0)
+            parts.append(piece)
+    if parts:
+        chunks.append('\n'.join(parts))
+    return chunks
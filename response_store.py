@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+import logging
+
+
+class SqliteResponseStore:
+    # Response cache shared by every process on the host (bot and broadcaster). Readers judge freshness
+    # with their own max age, so /get_latest can reuse a district the broadcaster fetched seconds earlier.
+    # Entries expire after `ttl` and the least recently used ones are dropped past `max_entries`.
+    DEFAULT_FILE = os.environ.get('COWIN_RESPONSE_CACHE_FILE', 'fetched_data/response_cache.sqlite')
+
+    def __init__(self, file_name = DEFAULT_FILE, ttl = 3600, max_entries = 4096):
+        self.file_name = file_name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.puts_since_evict = 0
+        with self._conn() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                fetched_at REAL,
+                                last_access REAL,
+                                etag TEXT,
+                                last_modified TEXT,
+                                body_hash TEXT,
+                                body BLOB)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_responses_last_access ON responses(last_access)')
+
+    def _conn(self):
+        # sqlite connections can't be shared across threads, keep one per thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.file_name, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(area_code, date_str, is_pin_code_based):
+        return '{}:{}:{}'.format('pin' if is_pin_code_based else 'dist', area_code, date_str)
+
+    def get(self, key):
+        # returns (body, etag, last_modified, body_hash, fetched_at) for an unexpired entry, callers judge freshness from fetched_at
+        try:
+            with self._conn() as conn:
+                row = conn.execute('SELECT fetched_at, etag, last_modified, body_hash, body FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+                fetched_at, etag, last_modified, body_hash, body = row
+                now = time.time()
+                if now - fetched_at > self.ttl:
+                    return None
+                conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+                return zlib.decompress(body), etag, last_modified, body_hash, fetched_at
+        except (sqlite3.Error, zlib.error) as ee:
+            logging.error("Shared cache read failed for {}. {}".format(key, ee))
+            return None
+
+    def put(self, key, body, etag, last_modified, body_hash):
+        now = time.time()
+        try:
+            with self._conn() as conn:
+                conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (key, now, now, etag, last_modified, body_hash, zlib.compress(body)))
+            self.puts_since_evict += 1
+            if self.puts_since_evict >= 64:
+                self.evict()
+        except sqlite3.Error as ee:
+            logging.error("Shared cache write failed for {}. {}".format(key, ee))
+
+    def touch(self, key):
+        # a 304 revalidated the entry, it is fresh again
+        now = time.time()
+        try:
+            with self._conn() as conn:
+                conn.execute('UPDATE responses SET fetched_at = ?, last_access = ? WHERE key = ?', (now, now, key))
+        except sqlite3.Error as ee:
+            logging.error("Shared cache write failed for {}. {}".format(key, ee))
+
+    def evict(self):
+        self.puts_since_evict = 0
+        with self._conn() as conn:
+            conn.execute('DELETE FROM responses WHERE fetched_at < ?', (time.time() - self.ttl,))
+            conn.execute('''DELETE FROM responses WHERE key IN (
+                                SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)''', (self.max_entries,))
@@ -0,0 +1,138 @@
+from array import array
+from collections import defaultdict
+from datetime import timedelta
+
+from sqlalchemy import select, func
+
+from db_models import User, Subscription
+
+
+class SubscriptionIndex:
+    # area -> age group -> user ids of subscribed users, kept across broadcast runs.
+    # A user's subscriptions are the area in `users` plus any active rows in `subscriptions`, all
+    # switched off together while users.is_subscribed is false. Loaded once with column-only queries,
+    # then refreshed with just the rows whose `updated_at` is at or after the last seen watermark.
+    def __init__(self):
+        self.area_to_age_to_user_ids = defaultdict( lambda : defaultdict(lambda : array('q')) )
+        self.user_to_primary = {}       # user_id -> (area_type, area_code, age_group) from `users`, for subscribed users
+        self.user_to_extra = defaultdict(set)   # user_id -> {(area_type, area_code, age_group)} from `subscriptions`
+        self.user_to_subscriptions = {}     # user_id -> frozenset of what is currently in area_to_age_to_user_ids
+        self.user_watermark = None
+        self.subscription_watermark = None
+
+    @staticmethod
+    def _sub(area_type, area_code, age_group):
+        return (area_type, str(area_code), int(age_group))
+
+    def _user_query(self, since = None):
+        stmt = select(User.user_id, User.area_type, User.area_code, User.age_group, User.is_subscribed, User.updated_at)
+        if since is not None:
+            stmt = stmt.where(User.updated_at >= since)
+        else:
+            stmt = stmt.where(User.is_subscribed == True)
+        return stmt
+
+    def _subscription_query(self, since = None):
+        stmt = select(Subscription.user_id, Subscription.area_type, Subscription.area_code, Subscription.age_group,
+                        Subscription.is_active, Subscription.updated_at)
+        if since is not None:
+            stmt = stmt.where(Subscription.updated_at >= since)
+        else:
+            stmt = stmt.where(Subscription.is_active == True)
+        return stmt
+
+    def load(self, db_session):
+        self.area_to_age_to_user_ids.clear()
+        self.user_to_primary.clear()
+        self.user_to_extra.clear()
+        self.user_to_subscriptions.clear()
+        self.user_watermark = db_session.execute(select(func.max(User.updated_at))).scalar()
+        self.subscription_watermark = db_session.execute(select(func.max(Subscription.updated_at))).scalar()
+        self._apply_user_rows(db_session.execute(self._user_query()))
+        self._apply_subscription_rows(db_session.execute(self._subscription_query()))
+
+    def refresh(self, db_session):
+        if self.user_watermark is None and self.subscription_watermark is None:
+            return self.load(db_session)
+        # re-read a second of overlap (DATETIME columns have 1s precision), applying a row twice is harmless
+        num_changes = self._apply_user_rows(db_session.execute(
+                            self._user_query(self.user_watermark - timedelta(seconds=1) if self.user_watermark else None)))
+        num_changes += self._apply_subscription_rows(db_session.execute(
+                            self._subscription_query(self.subscription_watermark - timedelta(seconds=1) if self.subscription_watermark else None)))
+        return num_changes
+
+    def _apply_user_rows(self, rows):
+        num_changes = 0
+        for user_id, area_type, area_code, age_group, is_subscribed, updated_at in rows:
+            self.apply(user_id, area_type, area_code, age_group, is_subscribed)
+            if updated_at is not None and (self.user_watermark is None or updated_at > self.user_watermark):
+                self.user_watermark = updated_at
+            num_changes += 1
+        return num_changes
+
+    def _apply_subscription_rows(self, rows):
+        num_changes = 0
+        for user_id, area_type, area_code, age_group, is_active, updated_at in rows:
+            self.apply_extra(user_id, area_type, area_code, age_group, is_active)
+            if updated_at is not None and (self.subscription_watermark is None or updated_at > self.subscription_watermark):
+                self.subscription_watermark = updated_at
+            num_changes += 1
+        return num_changes
+
+    def apply(self, user_id, area_type, area_code, age_group, is_subscribed):
+        # a `users` row: the primary subscription and the on/off switch for all of the user's subscriptions
+        if is_subscribed:
+            self.user_to_primary[user_id] = self._sub(area_type, area_code, age_group)
+        else:
+            self.user_to_primary.pop(user_id, None)
+        self._sync(user_id)
+
+    def apply_extra(self, user_id, area_type, area_code, age_group, is_active):
+        sub = self._sub(area_type, area_code, age_group)
+        if is_active:
+            self.user_to_extra[user_id].add(sub)
+        elif user_id in self.user_to_extra:
+            self.user_to_extra[user_id].discard(sub)
+            if not self.user_to_extra[user_id]:
+                del self.user_to_extra[user_id]
+        self._sync(user_id)
+
+    def _sync(self, user_id):
+        primary = self.user_to_primary.get(user_id)
+        if primary is None:
+            new_subs = frozenset()      # paused (or unknown) users get nothing, extra subscriptions included
+        else:
+            new_subs = frozenset(self.user_to_extra.get(user_id, ())) | {primary}
+        old_subs = self.user_to_subscriptions.get(user_id, frozenset())
+        if old_subs == new_subs:
+            return
+        for sub in old_subs - new_subs:
+            self._remove(user_id, sub)
+        for area_type, area_code, age_group in new_subs - old_subs:
+            self.area_to_age_to_user_ids[(area_type, area_code)][age_group].append(user_id)
+        if new_subs:
+            self.user_to_subscriptions[user_id] = new_subs
+        else:
+            del self.user_to_subscriptions[user_id]
+
+    def _remove(self, user_id, subscription):
+        area_type, area_code, age_group = subscription
+        age_to_user_ids = self.area_to_age_to_user_ids[(area_type, area_code)]
+        age_to_user_ids[age_group].remove(user_id)
+        if not age_to_user_ids[age_group]:
+            del age_to_user_ids[age_group]
+        if not age_to_user_ids:
+            del self.area_to_age_to_user_ids[(area_type, area_code)]
+
+    def get_subscriptions(self, user_id):
+        return self.user_to_subscriptions.get(user_id, frozenset())
+
+    def segregate_user_groups(self):
+        dist_to_age_to_user_ids, pincode_to_age_to_user_ids = {}, {}
+        for (area_type, area_code), age_to_user_ids in self.area_to_age_to_user_ids.items():
+            target = pincode_to_age_to_user_ids if area_type == 'pincode' else dist_to_age_to_user_ids
+            target[area_code] = age_to_user_ids
+        return dist_to_age_to_user_ids, pincode_to_age_to_user_ids
+
+    def __len__(self):
+        return len(self.user_to_subscriptions)